@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for turbokeys programming throughput and latency
+
+Runs against the in-memory SimulatedKeyboard by default, and against a real
+keyboard with --device (this writes to the keyboard's flash). Results are
+written as JSON and can be compared against a stored baseline:
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json
+"""
+
+import json
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import turbokeys
+from turbokeys import KeyMapping, KeyType, MiniKeyboard, SimulatedKeyboard
+
+
+# Metric name suffix -> whether a bigger value is better
+HIGHER_IS_BETTER = {'_per_s': True, '_s': False}
+
+
+def full_profile() -> List[KeyMapping]:
+    """An 18-key x 3-layer profile: 12 basic keys and 6 media keys per layer"""
+    mappings = []
+    for layer in (1, 2, 3):
+        for key in range(1, 13):
+            mappings.append(KeyMapping(key, KeyType.BASIC, turbokeys.Modifier.CTRL, 3 + key, layer))
+        for key in range(13, 19):
+            mappings.append(KeyMapping(key, KeyType.MEDIA, keycode=233, layer=layer))
+    return mappings
+
+
+def measure(func: Callable[[], None], iterations: int) -> Dict[str, float]:
+    """Time func over several iterations; returns median and best in seconds"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {'median': statistics.median(samples), 'min': min(samples)}
+
+
+def bench_apply(kb: MiniKeyboard, iterations: int) -> Dict[str, float]:
+    mappings = full_profile()
+
+    def run():
+        if not kb.apply_profile(mappings):
+            raise RuntimeError("apply_profile failed")
+
+    result = measure(run, iterations)
+    return {'apply_full_profile_s': result['median'],
+            'apply_full_profile_min_s': result['min']}
+
+
+def bench_write_report(kb: MiniKeyboard, packets: int) -> Dict[str, float]:
+    # An all-zero report is ignored by the firmware, so it is safe to repeat
+    report = [0] * 8
+    start = time.perf_counter()
+    for _ in range(packets):
+        kb._write_report(report)
+    elapsed = time.perf_counter() - start
+    return {'write_report_per_s': packets / elapsed}
+
+
+def bench_replay(kb: MiniKeyboard, iterations: int) -> Dict[str, float]:
+    """Replay a recorded full-profile apply at maximum speed"""
+    import os
+    import tempfile
+
+    fd, path = tempfile.mkstemp(suffix='.tkcap')
+    os.close(fd)
+    try:
+        kb.recorder = turbokeys.packet_recorder(path)
+        try:
+            kb.apply_profile(full_profile())
+        finally:
+            kb.recorder.close()
+            kb.recorder = None
+
+        with turbokeys.Capture(path) as capture:
+            packets = len(capture)
+            result = measure(lambda: turbokeys.replay_packets(kb, capture, speed=0), iterations)
+    finally:
+        os.remove(path)
+    return {'replay_packets_per_s': packets / result['median']}
+
+
+def bench_connect(make_keyboard: Callable[[], MiniKeyboard], dev_info: Optional[dict],
+                  iterations: int) -> Dict[str, float]:
+    """Time connect() split into enumerate / open / detect"""
+    enumerate_s, open_s, detect_s = [], [], []
+
+    for _ in range(iterations):
+        kb = make_keyboard()
+
+        info = dev_info
+        if info is None:
+            start = time.perf_counter()
+            turbokeys.invalidate_device_cache()
+            info = kb.find_device()
+            enumerate_s.append(time.perf_counter() - start)
+            if info is None:
+                raise RuntimeError("Keyboard disappeared during benchmark")
+
+        start = time.perf_counter()
+        kb.device = kb._open(info)
+        open_s.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        kb._detect_version()
+        detect_s.append(time.perf_counter() - start)
+
+        kb.device.close()
+        kb.device = None
+
+    results = {'connect_open_s': statistics.median(open_s),
+               'connect_detect_s': statistics.median(detect_s)}
+    if enumerate_s:
+        results['connect_enumerate_s'] = statistics.median(enumerate_s)
+    return results
+
+
+def bench_parse(iterations: int) -> Dict[str, float]:
+    combos = ['a', 'ctrl+c', 'ctrl+shift+escape', 'alt+f4', 'win+l', 'shift+pagedown']
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for combo in combos:
+            turbokeys.parse_key_combo(combo)
+    elapsed = time.perf_counter() - start
+    return {'parse_key_combo_per_s': iterations * len(combos) / elapsed}
+
+
+def bench_decode(iterations: int) -> Dict[str, float]:
+    # A knob spin: consumer press/release pairs, plus a typing burst
+    reports = [turbokeys.InputReport(0.0, 1, data) for data in (
+        bytes([3, 0xe9, 0]), bytes([3, 0, 0]),
+        bytes([0, 0, 4, 0, 0, 0, 0, 0]), bytes([2, 0, 4, 5, 0, 0, 0, 0]), bytes(8),
+    )]
+    decoder = turbokeys.ReportDecoder()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for report in reports:
+            decoder.decode(report)
+    elapsed = time.perf_counter() - start
+    return {'decode_report_per_s': iterations * len(reports) / elapsed}
+
+
+def run_simulated(args) -> Dict[str, float]:
+    sim = SimulatedKeyboard(write_latency=args.latency)
+
+    def make_keyboard() -> MiniKeyboard:
+        return MiniKeyboard(transport=sim.transport)
+
+    kb = make_keyboard()
+    if not kb.connect(sim.device_info):
+        raise RuntimeError("Could not connect to simulated keyboard")
+
+    results = {}
+    results.update(bench_apply(kb, args.iterations))
+    results.update(bench_write_report(kb, args.packets))
+    results.update(bench_replay(kb, args.iterations))
+    kb.disconnect()
+    results.update(bench_connect(make_keyboard, sim.device_info, args.iterations))
+    results.update(bench_parse(args.parse_iterations))
+    results.update(bench_decode(args.parse_iterations))
+    return results
+
+
+def run_device(args) -> Optional[Dict[str, float]]:
+    kb = MiniKeyboard()
+    if not kb.connect():
+        return None
+
+    results = {}
+    try:
+        results.update(bench_apply(kb, args.iterations))
+        results.update(bench_write_report(kb, args.packets))
+    finally:
+        kb.disconnect()
+    results.update(bench_connect(MiniKeyboard, None, args.iterations))
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> bool:
+    """Print results next to the baseline; returns False if anything regressed"""
+    ok = True
+    for target, metrics in results.items():
+        base_metrics = baseline.get(target, {})
+        for name, value in sorted(metrics.items()):
+            base = base_metrics.get(name)
+            if not base:
+                print(f"  {target:6s} {name:28s} {value:14.6g}")
+                continue
+
+            higher_is_better = next((better for suffix, better in HIGHER_IS_BETTER.items()
+                                     if name.endswith(suffix)), False)
+            change = (value - base) / base
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            flag = '  REGRESSION' if regressed else ''
+            print(f"  {target:6s} {name:28s} {value:14.6g}  baseline {base:12.6g}  "
+                  f"{change:+7.1%}{flag}")
+            ok = ok and not regressed
+    return ok
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark turbokeys programming throughput')
+    parser.add_argument('--output', '-o', help='Write results as JSON to this file')
+    parser.add_argument('--baseline', '-b', help='Compare against a stored JSON result')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative slowdown before a metric counts as a regression (default: 0.2)')
+    parser.add_argument('--device', action='store_true',
+                        help='Also benchmark a real keyboard if one is attached (writes to its flash)')
+    parser.add_argument('--iterations', '-n', type=int, default=20,
+                        help='Iterations for apply/connect timings (default: 20)')
+    parser.add_argument('--packets', type=int, default=2000,
+                        help='Packets for the write throughput test (default: 2000)')
+    parser.add_argument('--parse-iterations', type=int, default=20000,
+                        help='Iterations for the parse and decode tests (default: 20000)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Simulated per-write latency in seconds (default: 0)')
+    args = parser.parse_args()
+
+    results = {'sim': run_simulated(args)}
+    if args.device:
+        device_results = run_device(args)
+        if device_results is None:
+            print("No keyboard attached, skipping device benchmarks")
+        else:
+            results['device'] = device_results
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sim_latency_s': args.latency,
+        },
+        'results': results,
+    }
+
+    ok = True
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+        ok = compare(results, baseline, args.tolerance)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Regression tests against SimulatedKeyboard (no hardware needed)
+
+Run with: python -m unittest test_turbokeys
+"""
+
+import os
+import tempfile
+import unittest
+
+from turbokeys import (ApplyJournal, KeyType, MiniKeyboard, ShadowStore,
+                       SimulatedKeyboard, device_id, parse_mapping)
+
+
+class InterruptedStreamTest(unittest.TestCase):
+    """An apply cut off by an unplug resumes after the last flashed layer"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = ApplyJournal(os.path.join(self.tmp.name, 'journal'))
+        self.shadow = ShadowStore(os.path.join(self.tmp.name, 'shadow.json'))
+        self.sim = SimulatedKeyboard(serial='T0001')
+        self.mappings = [parse_mapping('key1', 'ctrl+c', 1),
+                         parse_mapping('key2', 'volup', 2),
+                         parse_mapping('key3', 'a', 3)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def connect(self) -> MiniKeyboard:
+        kb = MiniKeyboard(shadow=self.shadow, journal=self.journal, transport=self.sim.transport)
+        kb.pacer.max_retries = 0
+        self.assertTrue(kb.connect(self.sim.device_info))
+        return kb
+
+    def test_resume_skips_flashed_layers(self):
+        kb = self.connect()
+        first = self.sim.write_count
+        # Stream: switch, key, flash per layer; fail the layer 2 key write
+        self.sim.fail_writes = {first + 4}
+        self.assertFalse(kb.apply_profile(self.mappings))
+        kb.disconnect()     # Unplug: the unflashed layer 2 write is lost
+        self.assertEqual(self.sim.mapping(2, layer=2), None)
+
+        pending = self.journal.pending(device_id(self.sim.device_info))
+        self.assertEqual(pending['sent'], 3)
+
+        self.sim.fail_writes = set()
+        self.sim.packets.clear()
+        kb = self.connect()
+        self.assertEqual(kb.resumed, (3, 9))
+        kb.disconnect()
+
+        # Layer 1 was not written again
+        resent = [packet for packet in self.sim.packets if packet[1] == 1]
+        self.assertEqual(resent, [])
+        self.assertEqual(self.sim.mapping(1, layer=1).keycode, self.mappings[0].keycode)
+        self.assertEqual(self.sim.mapping(2, layer=2).key_type, KeyType.MEDIA)
+        self.assertEqual(self.sim.mapping(3, layer=3).keycode, self.mappings[2].keycode)
+        self.assertIsNone(self.journal.pending(device_id(self.sim.device_info)))
+        self.assertEqual(self.shadow.changed(device_id(self.sim.device_info), self.mappings), [])
+
+    def test_unjournaled_stream_flashes_once(self):
+        kb = MiniKeyboard(transport=self.sim.transport)
+        self.assertTrue(kb.connect(self.sim.device_info))
+        flashes = self.sim.flash_count
+        self.assertTrue(kb.apply_profile(self.mappings))
+        kb.disconnect()
+        self.assertEqual(self.sim.flash_count - flashes, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
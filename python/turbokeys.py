@@ -9,10 +9,33 @@ Vendor ID: 0x1189 (4489)
 Product ID: 0x8890 (34960)
 """
 
-import hid
+import operator
+import os
+import re
+import struct
+import sys
+import threading
+import time
 from enum import IntEnum
-from typing import Optional, List, Tuple
-from dataclasses import dataclass
+from typing import Optional, List, Tuple, Dict, Any, Iterable, Iterator, Sequence, Callable
+from dataclasses import dataclass, field, asdict
+
+
+# Debug tooling lives in turbokeys_debug and is only imported when used
+_DEBUG_FUNCTIONS = ('debug_interfaces', 'debug_init_sequences', 'debug_set_key')
+
+
+def __getattr__(name: str):
+    if name in _DEBUG_FUNCTIONS:
+        import turbokeys_debug
+        return getattr(turbokeys_debug, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _hid():
+    """Import hidapi on first use, so --help, validation and dry runs never load it"""
+    import hid
+    return hid
 
 
 # Device identifiers
@@ -114,6 +137,20 @@ MEDIA_KEYCODES = {
 }
 
 
+# Mouse buttons (byte 2 of a mouse key packet, see MouseKeys.cs)
+MOUSE_BUTTONS = {
+    'lclick': 1, 'left_click': 1, 'mouse_left': 1,
+    'rclick': 2, 'right_click': 2, 'mouse_right': 2,
+    'mclick': 4, 'middle_click': 4, 'mouse_middle': 4,
+}
+
+# Mouse wheel steps (1 = up, -1 = down)
+MOUSE_WHEEL = {
+    'wheelup': 1, 'scrollup': 1,
+    'wheeldown': -1, 'scrolldown': -1,
+}
+
+
 # Physical key names for the 12-key + 1-knob layout
 PHYSICAL_KEYS = {
     'key1': 1, 'key2': 2, 'key3': 3, 'key4': 4,
@@ -130,6 +167,65 @@ PHYSICAL_KEYS = {
 }
 
 
+def _reverse_names(names: Dict[str, int], exclude: Iterable[str] = ()) -> Dict[int, str]:
+    """Map each code to its canonical name - the first alias listed for it not in exclude"""
+    exclude = set(exclude)
+    reverse: Dict[int, str] = {}
+    for name, code in names.items():
+        if name not in exclude:
+            reverse.setdefault(code, name)
+    return reverse
+
+
+# Modifier names in combo order, as (flag, name)
+MODIFIER_NAMES = [
+    (Modifier.CTRL, 'ctrl'), (Modifier.SHIFT, 'shift'), (Modifier.ALT, 'alt'), (Modifier.WIN, 'win'),
+    (Modifier.RCTRL, 'rctrl'), (Modifier.RSHIFT, 'rshift'), (Modifier.RALT, 'ralt'), (Modifier.RWIN, 'rwin'),
+]
+
+# Every modifier spelling accepted in a combo
+MODIFIER_ALIASES = {
+    'control': Modifier.CTRL, 'super': Modifier.WIN, 'meta': Modifier.WIN, 'gui': Modifier.WIN,
+    **{name: flag for flag, name in MODIFIER_NAMES},
+}
+
+# Reverse lookup tables, built once at import: code -> canonical name.
+# HID usages and physical keys are dense arrays indexed by code; boot
+# keyboard modifier usages (0xE0-0xE7) are included for report decoding.
+# Names that parse_mapping() reads as something else ('pause' is the media
+# key) are never canonical.
+KEYCODE_NAMES: List[Optional[str]] = [None] * 256
+for _code, _name in _reverse_names(KEYCODES, exclude=MEDIA_KEYCODES).items():
+    KEYCODE_NAMES[_code] = _name
+for _bit, (_flag, _name) in enumerate(MODIFIER_NAMES):
+    KEYCODE_NAMES[0xE0 + _bit] = _name
+
+MEDIA_KEYCODE_NAMES: Dict[int, str] = _reverse_names(MEDIA_KEYCODES)
+
+PHYSICAL_KEY_NAMES: List[Optional[str]] = [None] * 19
+for _code, _name in _reverse_names(PHYSICAL_KEYS).items():
+    PHYSICAL_KEY_NAMES[_code] = _name
+
+MOUSE_BUTTON_NAMES: Dict[int, str] = _reverse_names(MOUSE_BUTTONS)
+
+
+def keycode_name(keycode: int) -> str:
+    """Canonical name of a USB HID keycode, or its hex value if unnamed"""
+    name = KEYCODE_NAMES[keycode] if 0 <= keycode < 256 else None
+    return name or f"0x{keycode:02x}"
+
+
+def media_keycode_name(code: int) -> str:
+    """Canonical name of a media (consumer) code, or its hex value if unnamed"""
+    return MEDIA_KEYCODE_NAMES.get(code) or f"0x{code:02x}"
+
+
+def physical_key_name(physical_key: int) -> str:
+    """Canonical name of a physical key number, or 'keyN' if unnamed"""
+    name = PHYSICAL_KEY_NAMES[physical_key] if 0 <= physical_key < 19 else None
+    return name or f"key{physical_key}"
+
+
 @dataclass
 class KeyMapping:
     """Represents a key mapping configuration"""
@@ -138,588 +234,3183 @@ class KeyMapping:
     modifiers: int = 0
     keycode: int = 0
     layer: int = 1
+    # Multi-key macro: (modifiers, keycode) per keystroke, basic keys only
+    sequence: Tuple[Tuple[int, int], ...] = ()
+    # Mouse keys: keycode holds the button mask, these the movement (-128..127)
+    dx: int = 0
+    dy: int = 0
+    wheel: int = 0
 
 
-class MiniKeyboard:
-    """Interface to the mini keyboard device"""
+# Longest macro the firmware stores per key (Download_Click sequence indexes 1-5)
+MAX_SEQUENCE_LENGTH = 5
 
-    def __init__(self):
-        self.device: Optional[hid.device] = None
-        self.report_id: int = 3  # Default, will be detected
 
-    def find_device(self) -> Optional[dict]:
-        """Find the mini keyboard device - uses MI_01 like vendor software"""
-        for pid in PRODUCT_IDS:
-            devices = list(hid.enumerate(VENDOR_ID, pid))
-
-            # Vendor software uses MI_01 (interface 1), not MI_00!
-            # See HidOperations.cs line 60: hidDevice.DevicePath.IndexOf("mi_01")
-            for dev in devices:
-                path = dev.get('path', b'')
-                if isinstance(path, bytes):
-                    path = path.decode('utf-8', errors='ignore')
-
-                # Match vendor software behavior: use mi_01
-                if 'mi_01' in path.lower():
-                    return dev
-
-            # Fallback: try MI_00 (vendor-specific interface)
-            for dev in devices:
-                usage_page = dev.get('usage_page', 0)
-                iface = dev.get('interface_number', -1)
-                if usage_page == 0xff00 or iface == 0:
-                    return dev
-
-            # Last resort: return first device
-            if devices:
-                return devices[0]
-        return None
+@dataclass
+class Profile:
+    """A full keyboard configuration: key mappings on every layer plus LED mode"""
+    mappings: List[KeyMapping] = field(default_factory=list)
+    led_mode: Optional[int] = None
 
-    def connect(self) -> bool:
-        """Connect to the keyboard"""
-        dev_info = self.find_device()
-        if not dev_info:
-            return False
 
-        self.device = hid.device()
-        try:
-            self.device.open_path(dev_info['path'])
-            self.device.set_nonblocking(True)
-            self._detect_version()
-            return True
-        except Exception as e:
-            print(f"Failed to open device: {e}")
-            self.device = None
-            return False
+# Every packet is the report ID followed by an 8-byte report
+PACKET_SIZE = 9
 
-    def disconnect(self):
-        """Disconnect from the keyboard"""
-        if self.device:
-            self.device.close()
-            self.device = None
+# Precompiled packet layouts, one per packet type
+_LAYER_PACKET = struct.Struct('<BBB6x')      # report ID, 0xA1, layer
+_FLASH_PACKET = struct.Struct('<BBB6x')      # report ID, 0xAA, 0xAA (keys) / 0xA1 (LED)
+_BASIC_PACKET = struct.Struct('<7B2x')       # report ID, key, type, count, index, modifiers, keycode
+_MEDIA_PACKET = struct.Struct('<BBBH4x')     # report ID, key, type, 16-bit media code
+_MOUSE_PACKET = struct.Struct('<4B3bBx')     # report ID, key, type, buttons, dx, dy, wheel, modifiers
+_LED_PACKET = struct.Struct('<BBBB5x')       # report ID, 0xB0, type, mode
+_REPORT_PACKET = struct.Struct('<9B')       # report ID, 8 raw report bytes
+_EMPTY_REPORT = (0,) * 8
 
-    def _detect_version(self):
-        """Detect keyboard firmware version by trying different report IDs"""
-        test_data = [0] * 8
 
-        # Try report ID 3 first (most common)
-        for rid in [3, 0, 2]:
-            try:
-                self.device.write([rid] + test_data)
-                self.report_id = rid
-                return
-            except Exception:
-                continue
+class PacketStream:
+    """
+    Consecutive packets packed into one immutable buffer
 
-        # Default to 3 if all fail
-        self.report_id = 3
+    Indexing and iteration give read-only views into the buffer, created as
+    the packets are written, so compiling a stream allocates the buffer and
+    nothing per packet.
+    """
 
-    def _write_report(self, data: List[int]) -> bool:
-        """Write an 8-byte report to the device"""
-        if not self.device:
-            return False
+    __slots__ = ('data',)
 
-        # Ensure data is exactly 8 bytes
-        report = (data + [0] * 8)[:8]
+    def __init__(self, data: bytes = b''):
+        self.data = data
 
-        try:
-            self.device.write([self.report_id] + report)
-            return True
-        except Exception as e:
-            print(f"Write failed: {e}")
-            return False
+    def __len__(self) -> int:
+        return len(self.data) // PACKET_SIZE
 
-    def _send_layer_switch(self, layer: int) -> bool:
-        """Send layer switch command"""
-        if layer < 1:
-            layer = 1
-        return self._write_report([0xA1, layer, 0, 0, 0, 0, 0, 0])
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("packet index out of range")
+        return memoryview(self.data)[index * PACKET_SIZE:(index + 1) * PACKET_SIZE]
 
-    def _send_flash_command(self, is_led: bool = False) -> bool:
-        """Send command to write configuration to flash"""
-        second_byte = 0xA1 if is_led else 0xAA
-        return self._write_report([0xAA, second_byte, 0, 0, 0, 0, 0, 0])
+    def __iter__(self) -> Iterator[memoryview]:
+        view = memoryview(self.data)
+        for offset in range(0, len(view), PACKET_SIZE):
+            yield view[offset:offset + PACKET_SIZE]
 
-    def set_basic_key(self, physical_key: int, keycode: int,
-                      modifiers: int = 0, layer: int = 1) -> bool:
-        """
-        Configure a physical key to send a basic keyboard key
+    def __add__(self, other: 'PacketStream') -> 'PacketStream':
+        return PacketStream(self.data + other.data)
 
-        Args:
-            physical_key: Physical key number (1-18)
-            keycode: USB HID keycode
-            modifiers: Modifier flags (Ctrl=1, Shift=2, Alt=4, Win=8)
-            layer: Layer number (1-3)
-        """
-        if not self.device:
-            return False
 
-        # Send layer switch for v2/v3 devices
-        if self.report_id != 0:
-            self._send_layer_switch(layer)
+class PacketEncoder:
+    """
+    Compiles key mappings into ready-to-send packets for one keyboard
 
-        # Build the key configuration packet
-        # Byte 0: Physical key number (1-18)
-        # Byte 1: Layer (upper nibble) | Key type (lower nibble)
-        # Byte 2: Number of keys in sequence (1 for single key)
-        # Byte 3: Sequence index (0 for first/only key)
-        # Byte 4: Modifiers
-        # Byte 5: Keycode
+    Single command packets are packed into one reusable per-device buffer,
+    so writing them allocates nothing. compile() turns a batch of mappings
+    into the complete immutable packet stream (layer switches, key packets
+    and the flash command) ahead of the write loop.
+    """
 
-        key_type = KeyType.BASIC
+    def __init__(self, report_id: int = 3):
+        self.report_id = report_id
+        self.buffer = bytearray(PACKET_SIZE)
 
+    def type_byte(self, key_type: KeyType, layer: int) -> int:
+        """Build byte 1 of a key packet: (layer << 4) | type, or type only on v0"""
         if self.report_id == 0:
-            type_byte = key_type & 0x0F
-        else:
-            type_byte = (layer << 4) | (key_type & 0x0F)
+            return key_type & 0x0F
+        return (layer << 4) | (key_type & 0x0F)
 
-        # Send the key mapping
-        data = [physical_key, type_byte, 1, 0, modifiers, keycode, 0, 0]
-        if not self._write_report(data):
-            return False
+    def report(self, data: Sequence[int]) -> bytearray:
+        """Pack an arbitrary report (zero-padded/truncated to 8 bytes) into the buffer"""
+        try:
+            _REPORT_PACKET.pack_into(self.buffer, 0, self.report_id, *data[:8], *_EMPTY_REPORT[len(data):])
+        except struct.error:
+            raise ValueError(f"Report bytes out of range (0..255): {list(data[:8])}") from None
+        return self.buffer
+
+    def layer_switch(self, layer: int) -> bytearray:
+        """Pack a layer switch (0xA1) command into the buffer"""
+        self._pack_layer_switch(self.buffer, 0, layer)
+        return self.buffer
+
+    def flash(self, is_led: bool = False) -> bytearray:
+        """Pack a flash (0xAA) command into the buffer"""
+        _FLASH_PACKET.pack_into(self.buffer, 0, self.report_id, 0xAA, 0xA1 if is_led else 0xAA)
+        return self.buffer
+
+    def led(self, mode: int) -> bytearray:
+        """Pack an LED mode packet into the buffer"""
+        self._pack_led(self.buffer, 0, mode)
+        return self.buffer
+
+    def _pack_layer_switch(self, buffer: bytearray, offset: int, layer: int):
+        layer = max(layer, 1)
+        _check_range("Layer", layer, 1, 15)
+        _LAYER_PACKET.pack_into(buffer, offset, self.report_id, 0xA1, layer)
+
+    def _pack_led(self, buffer: bytearray, offset: int, mode: int):
+        _check_range("LED mode", mode, 0, 255)
+        # LED uses special key number 176 (0xB0)
+        _LED_PACKET.pack_into(buffer, offset, self.report_id, 0xB0, KeyType.LED & 0x0F, mode)
 
-        # Write to flash
-        return self._send_flash_command()
+    @staticmethod
+    def packet_count(mapping: KeyMapping) -> int:
+        """Number of packets mapping_packets() produces for a mapping"""
+        steps = len(mapping.sequence)
+        return steps + 1 if mapping.key_type == KeyType.BASIC and steps > 1 else 1
 
-    def set_media_key(self, physical_key: int, media_keycode: int,
-                      layer: int = 1) -> bool:
+    def pack_mapping(self, buffer: bytearray, offset: int, mapping: KeyMapping) -> int:
         """
-        Configure a physical key to send a media key
+        Pack the configuration packet(s) for a key mapping into buffer at offset
 
-        Args:
-            physical_key: Physical key number (1-18)
-            media_keycode: Media key code
-            layer: Layer number (1-3)
-        """
-        if not self.device:
-            return False
+        Returns:
+            The offset just past the packed packets
 
+        Raises:
+            ValueError: If a field does not fit its packet
+        """
+        try:
+            return self._pack_mapping(buffer, offset, mapping)
+        except struct.error as e:
+            # Only a failed pack pays for the range checks that explain it
+            self._check_mapping(mapping)
+            raise ValueError(f"Cannot encode key mapping {mapping}: {e}") from None
+
+    def _pack_mapping(self, buffer: bytearray, offset: int, mapping: KeyMapping) -> int:
+        # Inlined type_byte(): this runs once per mapping in compile()
+        type_byte = mapping.key_type & 0x0F
+        if self.report_id != 0:
+            type_byte |= mapping.layer << 4
+
+        if mapping.key_type == KeyType.BASIC:
+            # Byte 0: Physical key number (1-18)
+            # Byte 1: Layer (upper nibble) | Key type (lower nibble)
+            # Byte 2: Number of keys in sequence (1 for single key)
+            # Byte 3: Sequence index (0 for first/only key)
+            # Byte 4: Modifiers
+            # Byte 5: Keycode
+            steps = mapping.sequence
+            if len(steps) <= 1:
+                modifiers, keycode = steps[0] if steps else (mapping.modifiers, mapping.keycode)
+                _BASIC_PACKET.pack_into(buffer, offset, self.report_id, mapping.physical_key,
+                                        type_byte, 1, 0, modifiers, keycode)
+                return offset + PACKET_SIZE
+
+            if len(steps) > MAX_SEQUENCE_LENGTH:
+                raise ValueError(f"Key sequence too long ({len(steps)} keys, "
+                                 f"max {MAX_SEQUENCE_LENGTH})")
+
+            # Multi-key macro, like the vendor Download_Click loop: a header
+            # packet (index 0, no keycode) followed by one packet per keystroke
+            count = len(steps)
+            _BASIC_PACKET.pack_into(buffer, offset, self.report_id, mapping.physical_key,
+                                    type_byte, count, 0, steps[0][0], 0)
+            for index, (modifiers, keycode) in enumerate(steps, 1):
+                _BASIC_PACKET.pack_into(buffer, offset + index * PACKET_SIZE, self.report_id,
+                                        mapping.physical_key, type_byte, count, index,
+                                        modifiers, keycode)
+            return offset + (count + 1) * PACKET_SIZE
+
+        if mapping.key_type == KeyType.MEDIA:
+            _MEDIA_PACKET.pack_into(buffer, offset, self.report_id, mapping.physical_key,
+                                    type_byte, mapping.keycode)
+            return offset + PACKET_SIZE
+
+        if mapping.key_type == KeyType.MOUSE:
+            _MOUSE_PACKET.pack_into(buffer, offset, self.report_id, mapping.physical_key,
+                                    type_byte, mapping.keycode, mapping.dx, mapping.dy,
+                                    mapping.wheel, mapping.modifiers)
+            return offset + PACKET_SIZE
+
+        raise ValueError(f"Unsupported key type for key mapping: {mapping.key_type!r}")
+
+    def _check_mapping(self, mapping: KeyMapping):
+        """Raise ValueError naming the field of mapping that does not fit its packet"""
+        _check_range("Physical key", mapping.physical_key, 0, 255)
         if self.report_id != 0:
-            self._send_layer_switch(layer)
+            _check_range("Layer", mapping.layer, 1, 15)
+        if mapping.key_type == KeyType.MOUSE:
+            _check_range("Mouse buttons", mapping.keycode, 0, 255)
+            if not all(-128 <= value <= 127 for value in (mapping.dx, mapping.dy, mapping.wheel)):
+                raise ValueError(f"Mouse movement out of range (-128..127): "
+                                 f"dx={mapping.dx} dy={mapping.dy} wheel={mapping.wheel}")
+        elif mapping.key_type == KeyType.MEDIA:
+            _check_range("Media keycode", mapping.keycode, 0, 0xFFFF)
+        else:
+            _check_range("Keycode", mapping.keycode, 0, 255)
+        _check_range("Modifiers", mapping.modifiers, 0, 255)
+        for modifiers, keycode in mapping.sequence:
+            _check_range("Modifiers", modifiers, 0, 255)
+            _check_range("Keycode", keycode, 0, 255)
+
+    def mapping_packets(self, mapping: KeyMapping) -> PacketStream:
+        """Encode the configuration packet(s) for a single key mapping"""
+        stream = bytearray(self.packet_count(mapping) * PACKET_SIZE)
+        self.pack_mapping(stream, 0, mapping)
+        return PacketStream(bytes(stream))
+
+    def compile(self, mappings: Iterable[KeyMapping]) -> PacketStream:
+        """
+        Compile mappings into the full packet stream for one batched write
 
-        key_type = KeyType.MEDIA
+        Mappings are grouped by layer with one layer switch per layer (v2/v3
+        firmware only), followed by a single key flash command, all packed
+        straight into one buffer.
+        """
+        # Sized for the longest macros, then trimmed, so packing is one pass
+        mappings = sorted(mappings, key=_mapping_layer)
+        stream = bytearray(((MAX_SEQUENCE_LENGTH + 2) * len(mappings) + 1) * PACKET_SIZE)
+        offset = 0
+        layer = None
+        pack = self._pack_mapping
+        try:
+            for mapping in mappings:
+                if mapping.layer != layer:
+                    layer = mapping.layer
+                    if self.report_id != 0:
+                        self._pack_layer_switch(stream, offset, layer)
+                        offset += PACKET_SIZE
+                offset = pack(stream, offset, mapping)
+        except struct.error as e:
+            self._check_mapping(mapping)
+            raise ValueError(f"Cannot encode key mapping {mapping}: {e}") from None
 
-        if self.report_id == 0:
-            type_byte = key_type & 0x0F
-        else:
-            type_byte = (layer << 4) | (key_type & 0x0F)
+        _FLASH_PACKET.pack_into(stream, offset, self.report_id, 0xAA, 0xAA)
+        return PacketStream(bytes(memoryview(stream)[:offset + PACKET_SIZE]))
 
-        data = [physical_key, type_byte, media_keycode, 0, 0, 0, 0, 0]
-        if not self._write_report(data):
-            return False
+    def compile_led(self, mode: int) -> PacketStream:
+        """The packet stream that sets and flashes an LED mode"""
+        stream = bytearray(2 * PACKET_SIZE)
+        self._pack_led(stream, 0, mode)
+        _FLASH_PACKET.pack_into(stream, PACKET_SIZE, self.report_id, 0xAA, 0xA1)
+        return PacketStream(bytes(stream))
 
-        return self._send_flash_command()
 
-    def set_led_mode(self, mode: int) -> bool:
-        """
-        Set LED mode
+def _check_range(what: str, value: int, low: int, high: int):
+    if not low <= value <= high:
+        raise ValueError(f"{what} {value} out of range ({low}..{high})")
 
-        Args:
-            mode: LED mode (0=off, 1=on, 2=breathing, etc.)
-        """
-        if not self.device:
-            return False
 
-        # LED uses special key number 176 (0xB0)
-        key_type = KeyType.LED
-        type_byte = key_type & 0x0F
+_mapping_layer = operator.attrgetter('layer')
 
-        data = [0xB0, type_byte, mode, 0, 0, 0, 0, 0]
-        if not self._write_report(data):
-            return False
 
-        return self._send_flash_command(is_led=True)
+def _cache_dir() -> str:
+    """Directory for persistent per-user state (override with TURBOKEYS_CACHE_DIR)"""
+    override = os.environ.get('TURBOKEYS_CACHE_DIR')
+    if override:
+        return override
 
-    def is_connected(self) -> bool:
-        """Check if device is connected"""
-        return self.device is not None
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'turbokeys')
 
 
-def parse_key_combo(combo_str: str) -> Tuple[int, int]:
+def device_id(dev_info: dict) -> str:
     """
-    Parse a key combination string like 'ctrl+shift+a' into modifiers and keycode
+    Stable identifier for a keyboard: its USB serial number, or its port path
 
-    Returns:
-        Tuple of (modifiers, keycode)
+    The OS device path is only a last resort: hidraw numbers are reused
+    across replugs, so a different keyboard could inherit the record.
     """
-    parts = combo_str.lower().replace(' ', '').split('+')
-    modifiers = 0
-    keycode = 0
+    serial = dev_info.get('serial_number') or ''
+    if serial:
+        return f"serial:{serial}"
 
-    for part in parts:
-        if part in ('ctrl', 'control'):
-            modifiers |= Modifier.CTRL
-        elif part == 'shift':
-            modifiers |= Modifier.SHIFT
-        elif part == 'alt':
-            modifiers |= Modifier.ALT
-        elif part in ('win', 'super', 'meta', 'gui'):
-            modifiers |= Modifier.WIN
-        elif part in KEYCODES:
-            keycode = KEYCODES[part]
-        elif len(part) == 1 and part.isalpha():
-            keycode = KEYCODES.get(part, 0)
+    path = _path_str(dev_info)
+    port = _port_path(dev_info)
+    if port != path:
+        return f"port:{port}"
+    return f"path:{path}"
 
-    return modifiers, keycode
 
+class _JsonStore:
+    """A JSON file of per-device records, safe to share between threads"""
 
-def list_devices():
-    """List all connected mini keyboards"""
-    devices = []
-    for pid in PRODUCT_IDS:
-        devices.extend(hid.enumerate(VENDOR_ID, pid))
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
 
-    if not devices:
-        print("No mini keyboard devices found")
-        print(f"Looking for VID=0x{VENDOR_ID:04x} with PIDs: {', '.join(f'0x{p:04x}' for p in PRODUCT_IDS)}")
-        return
+    def _read(self) -> Dict[str, Any]:
+        import json
 
-    print(f"Found {len(devices)} device interface(s):")
-    for dev in devices:
-        print(f"  Path: {dev['path']}")
-        print(f"  VID:PID = 0x{dev['vendor_id']:04x}:0x{dev['product_id']:04x}")
-        print(f"  Manufacturer: {dev.get('manufacturer_string', 'N/A')}")
-        print(f"  Product: {dev.get('product_string', 'N/A')}")
-        print(f"  Interface: {dev.get('interface_number', 'N/A')}")
-        print(f"  Usage Page: 0x{dev.get('usage_page', 0):04x}")
-        print(f"  Usage: 0x{dev.get('usage', 0):04x}")
-        print()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, data: Dict[str, Any]):
+        import json
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the record stored under key, if any"""
+        with self._lock:
+            return self._read().get(key)
+
+    def put(self, key: str, value: Any):
+        """Store a record under key (re-reads the file so other writers are kept)"""
+        with self._lock:
+            data = self._read()
+            data[key] = value
+            self._write(data)
+
+    def discard(self, key: str):
+        """Remove the record stored under key"""
+        with self._lock:
+            data = self._read()
+            if data.pop(key, None) is not None:
+                self._write(data)
+
+
+def _port_path(dev_info: dict) -> str:
+    """Best-effort USB port location of an interface (e.g. '1-2.4'), else its path"""
+    path = _path_str(dev_info)
+
+    # Linux hidraw: /sys/class/hidraw/hidrawN/device resolves into the USB
+    # interface directory, named <port>:<config>.<interface>
+    if path.startswith('/dev/hidraw'):
+        sys_path = os.path.realpath(f"/sys/class/hidraw/{os.path.basename(path)}/device")
+        for part in reversed(sys_path.split(os.sep)):
+            match = re.match(r'^(\d+-[\d.]+):\d+\.\d+$', part)
+            if match:
+                return match.group(1)
+
+    return path
+
+
+class DeviceInfoCache(_JsonStore):
+    """
+    Persistent record of what connect() learned about each keyboard
 
+    Holds the detected report ID and the chosen configuration interface,
+    keyed by PID, USB serial number and port path, so a reconnect can skip
+    the report ID probe writes.
+    """
 
-def monitor_device(duration: int = 10):
-    """Monitor HID traffic from the keyboard"""
-    import time
+    def __init__(self, path: Optional[str] = None):
+        super().__init__(path or os.path.join(_cache_dir(), 'devices.json'))
+
+    @staticmethod
+    def key(dev_info: dict) -> str:
+        """Cache key for an interface: PID, serial number and port path"""
+        serial = dev_info.get('serial_number') or ''
+        return f"{dev_info.get('product_id', 0):04x}|{serial}|{_port_path(dev_info)}"
+
+    def report_id(self, dev_info: dict) -> Optional[int]:
+        """Return the cached report ID for an interface, if known"""
+        entry = self.get(self.key(dev_info))
+        if not entry or entry.get('path') != _path_str(dev_info):
+            return None
+        return entry.get('report_id')
+
+    def remember(self, dev_info: dict, report_id: int):
+        """Record the report ID detected on an interface"""
+        self.put(self.key(dev_info), {
+            'report_id': report_id,
+            'path': _path_str(dev_info),
+            'interface_number': dev_info.get('interface_number', -1),
+        })
+
+    def forget(self, dev_info: dict):
+        """Drop the cached entry for an interface"""
+        self.discard(self.key(dev_info))
+
+    def write_interval(self, product_id: int) -> Optional[float]:
+        """Return the learned inter-packet interval for a keyboard model, if known"""
+        entry = self.get(f"model|{product_id:04x}")
+        return entry.get('write_interval') if entry else None
+
+    def remember_write_interval(self, product_id: int, interval: float):
+        """Record the inter-packet interval that worked for a keyboard model"""
+        self.put(f"model|{product_id:04x}", {'write_interval': interval})
+
+
+class WritePacer:
+    """
+    Paces packet writes to what the firmware can absorb
+
+    Packets go out back to back while writes succeed. A failed write is
+    retried after a backoff that doubles on every attempt, and the gap kept
+    between packets doubles as well; a write that succeeds but takes longer
+    than slow_write also widens the gap. After recover_after clean writes in
+    a row the gap is halved again, so the interval settles just above what
+    the keyboard needs.
+    """
 
-    devices = []
-    for pid in PRODUCT_IDS:
-        devices.extend(hid.enumerate(VENDOR_ID, pid))
+    def __init__(self, interval: float = 0.0, max_interval: float = 0.1,
+                 max_retries: int = 3, backoff: float = 0.005,
+                 slow_write: float = 0.25, recover_after: int = 16):
+        """
+        Args:
+            interval: Starting gap between packets, in seconds
+            max_interval: Largest gap the pacer will back off to
+            max_retries: Retries of a failed write before giving up
+            backoff: Delay before the first retry (doubles per retry)
+            slow_write: Writes taking longer than this count as congestion
+            recover_after: Clean writes needed before the gap is halved
+        """
+        self.interval = interval
+        self.max_interval = max_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.slow_write = slow_write
+        self.recover_after = recover_after
+        self._streak = 0
+        self._last_write = 0.0
+
+    def wait(self):
+        """Block until the current inter-packet gap has passed"""
+        if self.interval:
+            delay = self._last_write + self.interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _widen(self):
+        self.interval = min(self.max_interval, max(self.interval * 2, self.backoff / 4))
+        self._streak = 0
+
+    def success(self, duration: float):
+        """Record a completed write that took duration seconds"""
+        self._last_write = time.perf_counter()
+        if duration > self.slow_write:
+            self._widen()
+            return
+
+        self._streak += 1
+        if self.interval and self._streak >= self.recover_after:
+            self.interval /= 2
+            if self.interval < 0.0001:
+                self.interval = 0.0
+            self._streak = 0
+
+    def reset(self, interval: float):
+        """Forget the congestion seen so far and restart from interval"""
+        self.interval = interval
+        self._streak = 0
+
+    def failure(self, attempt: int):
+        """Record a failed write and sleep before retry number attempt (0-based)"""
+        self._last_write = time.perf_counter()
+        self._widen()
+        time.sleep(self.backoff * (2 ** attempt))
+
+
+def _slot_key(mapping: KeyMapping) -> str:
+    return f"{mapping.layer}:{mapping.physical_key}"
+
+
+def _slot_value(mapping: KeyMapping) -> Dict[str, Any]:
+    value = asdict(mapping)
+    del value['layer'], value['physical_key']
+    value['key_type'] = int(mapping.key_type)
+    # Same shape as the JSON round trip, so stored records compare equal
+    value['sequence'] = [list(step) for step in mapping.sequence]
+    return value
+
+
+class ShadowStore(_JsonStore):
+    """
+    Persistent record of the last configuration written to each keyboard
 
-    if not devices:
-        print("No devices found")
-        return
+    Records are keyed by device_id() and hold every key slot ("layer:key")
+    and the LED mode that were successfully flashed, so a profile can be
+    re-applied by sending only the slots that differ.
+    """
 
-    print(f"Monitoring keyboard for {duration} seconds. Press keys on the keyboard...")
-    print("(Watching all interfaces that can be read)\n")
+    def __init__(self, path: Optional[str] = None):
+        super().__init__(path or os.path.join(_cache_dir(), 'shadow.json'))
 
-    # Open all readable interfaces
-    open_devices = []
-    for i, dev_info in enumerate(devices):
-        try:
-            device = hid.device()
-            device.open_path(dev_info['path'])
-            device.set_nonblocking(True)
-            iface = dev_info.get('interface_number', '?')
-            usage = dev_info.get('usage_page', 0)
-            open_devices.append((device, f"iface{iface}_0x{usage:04x}"))
-            print(f"  Opened interface {iface} (usage 0x{usage:04x})")
-        except Exception as e:
-            pass
+    def changed(self, device: str, mappings: Iterable[KeyMapping]) -> List[KeyMapping]:
+        """Return the mappings that differ from what was last written to device"""
+        slots = (self.get(device) or {}).get('slots', {})
+        return [m for m in mappings if slots.get(_slot_key(m)) != _slot_value(m)]
 
-    if not open_devices:
-        print("Could not open any interfaces for reading")
-        return
+    def led_mode(self, device: str) -> Optional[int]:
+        """Return the LED mode last written to device, if known"""
+        return (self.get(device) or {}).get('led')
 
-    print(f"\nListening... (press keys now)\n")
+    def record(self, device: str, mappings: Iterable[KeyMapping] = (),
+               led_mode: Optional[int] = None):
+        """Record mappings (and optionally an LED mode) as written to device"""
+        with self._lock:
+            data = self._read()
+            entry = data.setdefault(device, {})
+            slots = entry.setdefault('slots', {})
+            for mapping in mappings:
+                slots[_slot_key(mapping)] = _slot_value(mapping)
+            if led_mode is not None:
+                entry['led'] = led_mode
+            self._write(data)
 
-    start = time.time()
-    while time.time() - start < duration:
-        for device, name in open_devices:
-            try:
-                data = device.read(64, timeout_ms=10)
-                if data:
-                    hex_str = ' '.join(f'{b:02x}' for b in data)
-                    print(f"[{name}] {hex_str}")
-            except Exception:
-                pass
 
-    # Close all
-    for device, _ in open_devices:
-        try:
-            device.close()
-        except:
-            pass
+def profile_hash(profile: Profile) -> str:
+    """Short content hash of a profile's key slots and LED mode"""
+    import hashlib
+    import json
 
-    print("\nDone monitoring.")
+    state = profile_state(profile)
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
 
+def profile_state(profile: Profile) -> Dict[str, Any]:
+    """
+    A profile as JSON-safe data with every mapping field spelled out
 
-    """Debug: probe all interfaces and try different protocols"""
-    import time
+    Unlike profile_to_dict(), nothing goes through key names, so
+    profile_from_state() gives back exactly the same mappings.
+    """
+    return {'led': profile.led_mode,
+            'slots': {_slot_key(m): _slot_value(m) for m in profile.mappings}}
 
-    devices = []
-    for pid in PRODUCT_IDS:
-        devices.extend(hid.enumerate(VENDOR_ID, pid))
 
-    if not devices:
-        print("No devices found")
-        return
+def profile_from_state(state: Dict[str, Any]) -> Profile:
+    """
+    Inverse of profile_state()
 
-    print(f"Found {len(devices)} interface(s). Testing each...\n")
+    Raises:
+        ValueError: If the data is not a valid profile state
+    """
+    try:
+        led = state.get('led')
+        mappings = [_slot_mapping(key, value) for key, value in state['slots'].items()]
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid profile state: {e}") from None
+    if led is not None and (isinstance(led, bool) or not isinstance(led, int) or not 0 <= led <= 255):
+        raise ValueError(f"Invalid LED mode {led!r}. Must be 0-255")
+    for mapping in mappings:
+        if not 1 <= mapping.layer <= 3 or not 1 <= mapping.physical_key < len(PHYSICAL_KEY_NAMES):
+            raise ValueError(f"Invalid key slot {_slot_key(mapping)}")
+    return Profile(mappings, led)
 
-    for i, dev_info in enumerate(devices):
-        path = dev_info['path']
-        if isinstance(path, bytes):
-            path_str = path.decode('utf-8', errors='ignore')
-        else:
-            path_str = path
 
-        print(f"=== Interface {i} ===")
-        print(f"Path: {path_str}")
-        print(f"Interface number: {dev_info.get('interface_number', 'N/A')}")
-        print(f"Usage page: 0x{dev_info.get('usage_page', 0):04x}")
-        print(f"Usage: 0x{dev_info.get('usage', 0):04x}")
+@dataclass
+class TransitionPlan:
+    """
+    The writes that turn a keyboard configured with one profile into another
 
-        try:
-            device = hid.device()
-            device.open_path(dev_info['path'])
-            device.set_nonblocking(True)
-            print("  Opened successfully")
-
-            # Try reading first to see if there's any data
-            print("  Attempting read...")
-            data = device.read(64, timeout_ms=500)
-            if data:
-                print(f"  Read data: {[hex(b) for b in data]}")
-            else:
-                print("  No data to read")
+    Only the slots whose mapping differs are written, grouped by layer and
+    committed with one flash; the LED is written only if its mode changes.
+    Slots that the target does not map are left alone, as apply does.
+    """
+    source: str                     # profile_hash() of the starting profile
+    target: str                     # profile_hash() of the resulting profile
+    mappings: List[KeyMapping]
+    led_mode: Optional[int] = None
+    target_profile: Optional[Profile] = None
+    _packets: Dict[int, PacketStream] = field(default_factory=dict, repr=False)
+
+    def packets(self, report_id: int) -> PacketStream:
+        """The packet stream for a report ID, compiled once and kept"""
+        packets = self._packets.get(report_id)
+        if packets is None:
+            encoder = PacketEncoder(report_id)
+            packets = encoder.compile(self.mappings) if self.mappings else PacketStream()
+            if self.led_mode is not None:
+                packets += encoder.compile_led(self.led_mode)
+            self._packets[report_id] = packets
+        return packets
+
+
+def transition_plan(source: Profile, target: Profile) -> TransitionPlan:
+    """Compute the minimal TransitionPlan from source to target"""
+    slots = {_slot_key(m): _slot_value(m) for m in source.mappings}
+    mappings = [m for m in target.mappings if slots.get(_slot_key(m)) != _slot_value(m)]
+    led_mode = target.led_mode if target.led_mode != source.led_mode else None
+    return TransitionPlan(profile_hash(source), profile_hash(target), mappings, led_mode, target)
+
+
+class TransitionPlanner:
+    """
+    Cache of transition plans between profiles
 
-            # Try different report IDs
-            for rid in [0, 2, 3]:
-                # Test write - just zeros
-                test_data = [rid] + [0] * 8
-                try:
-                    result = device.write(test_data)
-                    print(f"  Report ID {rid}: write OK ({result} bytes)")
-                except Exception as e:
-                    print(f"  Report ID {rid}: write FAIL - {e}")
+    Plans are keyed by the profiles' content hashes, so switching between a
+    set of common profiles is a dictionary lookup once each pair has been
+    planned (see precompute()), and the packets of each plan are compiled
+    only once per report ID. The least recently used plans are dropped
+    beyond max_plans.
+    """
 
-            # Try feature report
-            for rid in [0, 2, 3]:
-                try:
-                    feat = device.get_feature_report(rid, 9)
-                    if feat:
-                        print(f"  Feature report {rid}: {[hex(b) for b in feat]}")
-                except Exception as e:
-                    pass  # Feature reports often fail
+    def __init__(self, max_plans: int = 256):
+        from collections import OrderedDict
+
+        self.max_plans = max_plans
+        self._plans: 'OrderedDict[Tuple[str, str], TransitionPlan]' = OrderedDict()
+        self._hashes: Dict[int, Tuple[Profile, str]] = {}
+        self._lock = threading.Lock()
+
+    def _hash(self, profile: Profile) -> str:
+        # Hashing walks every mapping, so remember it per profile object
+        cached = self._hashes.get(id(profile))
+        if cached is None or cached[0] is not profile:
+            if len(self._hashes) >= 4 * self.max_plans:
+                self._hashes.clear()
+            cached = self._hashes[id(profile)] = (profile, profile_hash(profile))
+        return cached[1]
+
+    def plan(self, source: Profile, target: Profile) -> TransitionPlan:
+        """Return the plan from source to target, computing it on first use"""
+        key = (self._hash(source), self._hash(target))
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+
+        plan = transition_plan(source, target)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def precompute(self, profiles: Sequence[Profile], report_ids: Sequence[int] = (3,)):
+        """Plan every ordered pair of profiles and compile their packets"""
+        for source in profiles:
+            for target in profiles:
+                if source is not target:
+                    plan = self.plan(source, target)
+                    for report_id in report_ids:
+                        plan.packets(report_id)
+
+    def __len__(self) -> int:
+        return len(self._plans)
+
+
+def _slot_mapping(key: str, value: Dict[str, Any]) -> KeyMapping:
+    """Inverse of _slot_key()/_slot_value()"""
+    layer, physical_key = (int(part) for part in key.split(':'))
+    value = dict(value)
+    value['key_type'] = KeyType(value['key_type'])
+    value['sequence'] = tuple(tuple(step) for step in value.get('sequence', ()))
+    return KeyMapping(physical_key=physical_key, layer=layer, **value)
+
+
+def _is_layer_switch(packet: bytes) -> bool:
+    return packet[1] == 0xA1
+
+
+def _is_flash(packet: bytes) -> bool:
+    return packet[1] == 0xAA
+
+
+def _with_checkpoints(packets: Sequence[bytes], flash: bytes) -> List[bytes]:
+    """
+    Insert a key flash before each layer switch that follows unflashed key
+    writes, so every layer is committed (and can be journaled) on its own
+    """
+    checkpointed: List[bytes] = []
+    unflashed = False
+    for packet in packets:
+        if unflashed and _is_layer_switch(packet):
+            checkpointed.append(flash)
+            unflashed = False
+        checkpointed.append(packet)
+        if _is_flash(packet):
+            unflashed = unflashed and packet[2] == 0xA1
+        elif 1 <= packet[1] < len(PHYSICAL_KEY_NAMES):
+            unflashed = True
+    return checkpointed
+
+
+def _flashed(packets: Sequence[bytes], end: int) -> Tuple[List[str], bool]:
+    """
+    Slots ("layer:key") committed by the flashes among packets[:end], and
+    whether an LED mode was; writes after the last flash are not committed
+    """
+    committed: List[str] = []
+    written: List[str] = []
+    led = led_written = False
+    layer = 1
+    for packet in packets[:end]:
+        command = packet[1]
+        if _is_layer_switch(packet):
+            layer = max(packet[2], 1)
+        elif _is_flash(packet):
+            if packet[2] == 0xA1:
+                led = led or led_written
+                led_written = False
+            else:
+                committed.extend(written)
+                written = []
+        elif command == 0xB0:
+            led_written = True
+        elif 1 <= command < len(PHYSICAL_KEY_NAMES):
+            # v0 firmware has no layers; v2/v3 carry the layer in the type byte
+            written.append(f"{((packet[2] >> 4) or layer) if packet[0] != 0 else 1}:{command}")
+    return committed, led
+
+
+class JournalEntry:
+    """Progress of one journaled packet stream: ack() each flash the keyboard accepted"""
+
+    def __init__(self, journal: 'ApplyJournal', device: str, start: int = 0):
+        self.journal = journal
+        self.device = device
+        self.acked = start
+        _, ack_path = journal._paths(device)
+        # Appends land after the packets already acknowledged up to start
+        self._file = open(ack_path, 'ab')
+        self._file.truncate(start)
+
+    def ack(self, end: int):
+        """The packets before index end (ending with a flash) were accepted"""
+        # One byte per packet, flushed straight to the OS so it survives the
+        # process; only flashes are acknowledged, since an unplug loses
+        # every write after the last one anyway
+        self._file.write(b'\x01' * (end - self.acked))
+        self._file.flush()
+        self.acked = end
+
+    def close(self):
+        """Stop tracking but keep the journal, so the stream can be resumed"""
+        if not self._file.closed:
+            self._file.close()
+
+    def finish(self):
+        """The stream was sent completely: remove the journal"""
+        self.close()
+        self.journal.discard(self.device)
+
+
+class ApplyJournal:
+    """
+    Write-ahead journal of the packet streams being written to each keyboard
+
+    Before a stream is sent, its packets (and the slots and LED mode they
+    set) are stored in <device>.json. Journaled streams flash each layer
+    before switching to the next, and each flash the keyboard accepts
+    appends one byte per packet up to it to <device>.ack. If the process
+    dies or the keyboard is unplugged part way, the next connect finds the
+    journal and resumes after the last acknowledged flash, skipping the
+    layers already committed (see MiniKeyboard.resume_pending()).
+    """
 
-            device.close()
-        except Exception as e:
-            print(f"  Failed to open: {e}")
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(_cache_dir(), 'journal')
+
+    def _paths(self, device: str) -> Tuple[str, str]:
+        import hashlib
+
+        name = hashlib.sha1(device.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.path, f"{name}.json"), os.path.join(self.path, f"{name}.ack")
+
+    def begin(self, device: str, packets: Sequence[bytes], mappings: Iterable[KeyMapping] = (),
+              led_mode: Optional[int] = None) -> JournalEntry:
+        """Journal a stream about to be sent to device"""
+        mappings = list(mappings)
+        json_path, _ = self._paths(device)
+        os.makedirs(self.path, exist_ok=True)
+
+        # Reset the progress before the new stream replaces the old one
+        entry = JournalEntry(self, device)
+        _JsonStore(json_path)._write({
+            'device': device,
+            'profile': profile_hash(Profile(mappings, led_mode)),
+            'packets': [bytes(packet).hex() for packet in packets],
+            'slots': {_slot_key(m): _slot_value(m) for m in mappings},
+            'led': led_mode,
+        })
+        return entry
+
+    def pending(self, device: str) -> Optional[Dict[str, Any]]:
+        """
+        The interrupted stream journaled for device, if any
 
-        print()
+        Returns:
+            The journal record with 'packets' as bytes, 'sent' (packets
+            acknowledged) and 'flash_pending' (a flash is among the unsent
+            packets), or None
+        """
+        json_path, ack_path = self._paths(device)
+        data = _JsonStore(json_path)._read()
+        if data.get('device') != device:
+            return None
 
+        try:
+            packets = [bytes.fromhex(packet) for packet in data.get('packets', [])]
+            sent = min(os.path.getsize(ack_path), len(packets))
+        except (OSError, ValueError):
+            return None
+        data['packets'] = packets
+        data['sent'] = sent
+        data['flash_pending'] = any(_is_flash(packet) for packet in packets[sent:])
+        return data
+
+    def resume(self, device: str, start: int) -> JournalEntry:
+        """Continue tracking device's stream from packet index start"""
+        return JournalEntry(self, device, start)
+
+    def discard(self, device: str):
+        """Remove device's journal"""
+        for path in self._paths(device):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-def debug_init_sequences():
-    """Try various initialization sequences that might unlock configuration"""
-    import time
 
-    devices = list(hid.enumerate(VENDOR_ID, 0x8840))
-    if not devices:
-        print("No 0x8840 device found")
-        return
+def _path_str(dev_info: dict) -> str:
+    path = dev_info.get('path', b'')
+    if isinstance(path, bytes):
+        path = path.decode('utf-8', errors='ignore')
+    return path
 
-    # Find the vendor interface
-    dev_info = None
-    for d in devices:
-        if d.get('usage_page') == 0xff00:
-            dev_info = d
-            break
 
-    if not dev_info:
-        dev_info = devices[0]
+def _config_interfaces(devices: List[dict]) -> List[dict]:
+    """Pick the configuration interface of each keyboard among one PID's interfaces"""
+    # Vendor software uses MI_01 (interface 1), not MI_00!
+    # See HidOperations.cs line 60: hidDevice.DevicePath.IndexOf("mi_01")
+    matches = [dev for dev in devices if 'mi_01' in _path_str(dev).lower()]
 
-    print(f"Testing initialization sequences on 0x8840 device")
-    print(f"Interface: {dev_info.get('interface_number')}, Usage: 0x{dev_info.get('usage_page', 0):04x}\n")
+    # Fallback: try MI_00 (vendor-specific interface)
+    if not matches:
+        matches = [dev for dev in devices
+                   if dev.get('usage_page', 0) == 0xff00 or dev.get('interface_number', -1) == 0]
 
-    device = hid.device()
-    device.open_path(dev_info['path'])
-    device.set_nonblocking(True)
+    # Last resort: first device
+    if not matches:
+        return devices[:1]
 
-    rid = 3
-    key = 1
-    keycode = 4  # 'A'
-    layer = 1
-    type_byte = (layer << 4) | KeyType.BASIC
-
-    # Common initialization sequences to try
-    init_sequences = [
-        ("Enter config mode 0xA0", [[rid, 0xA0, 0, 0, 0, 0, 0, 0, 0]]),
-        ("Enter config mode 0xA2", [[rid, 0xA2, 0, 0, 0, 0, 0, 0, 0]]),
-        ("Enter config mode 0xAA", [[rid, 0xAA, 0, 0, 0, 0, 0, 0, 0]]),
-        ("Read config 0xB0", [[rid, 0xB0, 0, 0, 0, 0, 0, 0, 0]]),
-        ("Init 0xFF", [[rid, 0xFF, 0, 0, 0, 0, 0, 0, 0]]),
-        ("Reset 0x00", [[rid, 0, 0, 0, 0, 0, 0, 0, 0]]),
-        ("Wake sequence", [
-            [rid, 0xA1, 1, 0, 0, 0, 0, 0, 0],  # Layer 1
-            [rid, 0xA0, 0, 0, 0, 0, 0, 0, 0],  # Config mode?
-        ]),
-        ("Double layer switch", [
-            [rid, 0xA1, 0, 0, 0, 0, 0, 0, 0],  # Layer 0
-            [rid, 0xA1, 1, 0, 0, 0, 0, 0, 0],  # Layer 1
-        ]),
-    ]
-
-    for name, init_pkts in init_sequences:
-        print(f"\n=== {name} ===")
-        try:
-            # Send init
-            for pkt in init_pkts:
-                result = device.write(pkt)
-                print(f"  Init: {[hex(b) for b in pkt[1:]]} -> {result}b")
-                time.sleep(0.05)
-
-            # Check for response
-            resp = device.read(64, timeout_ms=100)
-            if resp:
-                print(f"  Response: {[hex(b) for b in resp]}")
-
-            # Try setting key
-            config = [rid, key, type_byte, 1, 0, 0, keycode, 0, 0]
-            result = device.write(config)
-            print(f"  Config: {result}b")
-
-            # Flash
-            flash = [rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0]
-            result = device.write(flash)
-            print(f"  Flash: {result}b")
-
-            # Check response
-            resp = device.read(64, timeout_ms=100)
-            if resp:
-                print(f"  Response: {[hex(b) for b in resp]}")
-
-            time.sleep(0.3)
-        except Exception as e:
-            print(f"  Error: {e}")
+    # One interface can be listed once per top-level collection
+    # (same path, or '&colNN' path suffixes on Windows) - keep the first
+    seen = set()
+    unique = []
+    for dev in matches:
+        key = re.sub(r'&col[0-9a-f]+', '', _path_str(dev).lower())
+        if key not in seen:
+            seen.add(key)
+            unique.append(dev)
+    return unique
 
-    # Try querying device info
-    print("\n=== Query device info ===")
-    query_cmds = [0x00, 0x01, 0x10, 0x20, 0x80, 0x90, 0xF0, 0xFF]
-    for cmd in query_cmds:
-        try:
-            device.write([rid, cmd, 0, 0, 0, 0, 0, 0, 0])
-            time.sleep(0.05)
-            resp = device.read(64, timeout_ms=100)
-            if resp:
-                print(f"  0x{cmd:02x}: {[hex(b) for b in resp]}")
-        except:
-            pass
 
-    device.close()
-    print("\nDone. Press key 1 to test if any sequence worked.")
+# Seconds an enumeration result stays valid; hotplug changes invalidate it sooner
+ENUMERATION_TTL = 2.0
 
+_enum_lock = threading.Lock()
+_enum_cache: Optional[Tuple[float, Any, List[dict]]] = None  # (time, hotplug signature, devices)
 
-def debug_set_key(physical_key: int = 1, keycode: int = 4):
-    """Debug: try setting a key on all interfaces with various protocols"""
-    import time
 
-    devices = []
-    for pid in PRODUCT_IDS:
-        devices.extend(hid.enumerate(VENDOR_ID, pid))
+def _hotplug_signature() -> Any:
+    """Cheap fingerprint of the attached HID devices, used to spot hotplug changes"""
+    try:
+        return tuple(sorted(os.listdir('/sys/class/hidraw')))
+    except OSError:
+        # No hidraw class (macOS, Windows): rely on the TTL alone
+        return None
 
-    if not devices:
-        print("No devices found")
-        return
 
-    print(f"Attempting to set key {physical_key} to keycode {keycode} (A)")
-    print(f"Found {len(devices)} interface(s)\n")
+def invalidate_device_cache():
+    """Forget the cached enumeration so the next lookup re-walks the USB bus"""
+    global _enum_cache
+    with _enum_lock:
+        _enum_cache = None
 
-    # Only test interface 0 (vendor-specific) with various protocols
-    dev_info = devices[0]
-    print(f"Testing interface 0 (MI_00, usage=0x{dev_info.get('usage_page', 0):04x})")
 
-    try:
-        device = hid.device()
-        device.open_path(dev_info['path'])
-        device.set_nonblocking(True)
+def enumerate_devices(refresh: bool = False) -> List[dict]:
+    """
+    Return every HID interface of every attached mini keyboard
 
-        rid = 3  # Only report ID that works
-        layer = 1
-        type_byte = (layer << 4) | KeyType.BASIC
+    A single hid.enumerate() pass over the vendor ID covers all PRODUCT_IDS.
+    The result is cached for ENUMERATION_TTL seconds, or until the set of
+    hidraw nodes changes (Linux).
 
-        # Protocol A: Try feature report instead of output report
-        print("\n=== Testing Feature Reports ===")
-        try:
-            feat_data = [rid, physical_key, type_byte, 1, 0, 0, keycode, 0, 0]
-            device.send_feature_report(feat_data)
-            print(f"  Feature report sent: {feat_data}")
-            device.send_feature_report([rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0])
-            print("  Flash feature sent")
-        except Exception as e:
-            print(f"  Feature report failed: {e}")
-
-        time.sleep(0.5)
-
-        # Protocol B: Different byte order - what if key number is byte 1 not byte 0?
-        print("\n=== Testing Alternate Byte Orders ===")
-        # Order 1: [cmd, key, type, ...]
-        packets = [
-            ("Cmd prefix", [rid, 0xA1, physical_key, type_byte, 1, 0, keycode, 0, 0]),
-            ("Key at byte 2", [rid, type_byte, physical_key, 1, 0, 0, keycode, 0, 0]),
-            ("Flat format", [rid, physical_key, keycode, 0, 0, 0, 0, 0, 0]),
-        ]
-        for name, pkt in packets:
-            try:
-                result = device.write(pkt)
-                print(f"  {name}: {pkt[1:]} -> {result} bytes")
-                device.write([rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0])
-            except Exception as e:
-                print(f"  {name} failed: {e}")
-            time.sleep(0.2)
+    Args:
+        refresh: Ignore the cache and enumerate again
+    """
+    global _enum_cache
+    signature = _hotplug_signature()
 
-        # Protocol C: Larger packet sizes
-        print("\n=== Testing Larger Packets (64 bytes) ===")
-        big_packet = [rid] + [physical_key, type_byte, 1, 0, 0, keycode] + [0] * 57
-        try:
-            result = device.write(big_packet)
-            print(f"  64-byte packet: {result} bytes")
-            device.write([rid] + [0xAA, 0xAA] + [0] * 61)
-        except Exception as e:
-            print(f"  64-byte failed: {e}")
+    with _enum_lock:
+        cached = _enum_cache
+        if (not refresh and cached is not None and cached[1] == signature
+                and time.monotonic() - cached[0] < ENUMERATION_TTL):
+            return list(cached[2])
 
-        time.sleep(0.5)
+        devices = [dev for dev in _hid().enumerate(VENDOR_ID, 0)
+                   if dev.get('product_id') in PRODUCT_IDS]
+        # Keep the PRODUCT_IDS preference order
+        devices.sort(key=lambda dev: PRODUCT_IDS.index(dev['product_id']))
 
-        # Protocol D: Try without report ID in data (raw write)
-        print("\n=== Testing Raw Writes ===")
-        raw_packets = [
-            [physical_key, type_byte, 1, 0, 0, keycode, 0, 0],
-            [0, physical_key, type_byte, 1, 0, 0, keycode, 0],
-        ]
-        for i, pkt in enumerate(raw_packets):
-            try:
-                result = device.write(pkt)
-                print(f"  Raw {i}: {pkt} -> {result} bytes")
-            except Exception as e:
-                print(f"  Raw {i} failed: {e}")
-
-        # Protocol E: Try reading response after write
-        print("\n=== Testing Write then Read ===")
-        device.write([rid, physical_key, type_byte, 1, 0, 0, keycode, 0, 0])
-        time.sleep(0.1)
-        response = device.read(64, timeout_ms=500)
-        if response:
-            print(f"  Response: {[hex(b) for b in response]}")
-        else:
-            print("  No response")
+        _enum_cache = (time.monotonic(), signature, devices)
+        return list(devices)
 
-        device.write([rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0])
-        time.sleep(0.1)
-        response = device.read(64, timeout_ms=500)
-        if response:
-            print(f"  Flash response: {[hex(b) for b in response]}")
-        else:
-            print("  No flash response")
 
-        device.close()
-    except Exception as e:
-        print(f"Failed: {e}")
+def find_devices(refresh: bool = False) -> List[dict]:
+    """Find the configuration interface of every attached mini keyboard"""
+    devices = enumerate_devices(refresh)
 
-    print("\n\nDone. Press key 1 to test.")
+    found = []
+    for pid in PRODUCT_IDS:
+        found.extend(_config_interfaces([dev for dev in devices if dev['product_id'] == pid]))
+    return found
+
+
+class PooledDevice:
+    """An open device handle owned by a DevicePool, leased to one user at a time"""
+
+    def __init__(self, pool: 'DevicePool', path: str):
+        self.pool = pool
+        self.path = path
+        self.dev_info: Optional[dict] = None
+        self.handle: Optional[Any] = None
+        self.report_id: Optional[int] = None    # Learned by the first MiniKeyboard to use it
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    def _open(self):
+        self.close()
+        handle = self.pool._transport()()
+        handle.open_path(self.dev_info['path'])
+        handle.set_nonblocking(True)
+        self.handle = handle
+
+    def close(self):
+        if self.handle is not None:
+            try:
+                self.handle.close()
+            except Exception:
+                pass
+            self.handle = None
 
+    def healthy(self) -> bool:
+        """
+        Check, without writing to the keyboard, that the handle is still usable
 
-def main():
-    """CLI interface"""
-    import argparse
+        The path must still be enumerated for the same keyboard (after a USB
+        reset it may belong to another one), and the handle must still
+        answer a string descriptor query.
+        """
+        if self.handle is None:
+            return False
+        key = device_id(self.dev_info)
+        if not any(_path_str(dev) == self.path and device_id(dev) == key
+                   for dev in self.pool.find_devices()):
+            return False
+        query = getattr(self.handle, 'get_product_string', None)
+        if query is None:
+            return True
+        try:
+            query()
+            return True
+        except Exception:
+            return False
+
+    def reopen(self) -> bool:
+        """
+        Close and reopen the handle, e.g. after a USB reset; returns True on success
+
+        The keyboard is looked up again by device_id(), since the reset may
+        have moved it to another path and given its old path to another
+        keyboard.
+        """
+        key = device_id(self.dev_info)
+        matches = [dev for dev in self.pool.find_devices(refresh=True) if device_id(dev) == key]
+        if not matches:
+            self.close()
+            return False
+        self.pool._move(self, matches[0])
+        try:
+            self._open()
+            return True
+        except Exception:
+            self.handle = None
+            return False
+
+
+class DevicePool:
+    """
+    Pool of open keyboard handles keyed by device path
+
+    connect()/disconnect() on a MiniKeyboard created with a pool lease and
+    return a handle instead of opening and closing the device, and the
+    report ID learned on the first connect is kept with the handle, so
+    repeated connects skip both the open and the probe. Each path has a
+    single handle leased to one MiniKeyboard at a time: concurrent users of
+    one keyboard wait for each other instead of racing two opens.
+
+    A handle idle for more than check_after seconds is checked before it is
+    leased and reopened if the check fails (e.g. after a USB reset). The
+    check does not write to the keyboard: it looks for the interface in a
+    fresh enumeration, and a reopen follows the keyboard's device_id() to
+    its new path. Handles idle for more than idle_timeout are closed.
+    """
+
+    def __init__(self, transport: Optional[Callable[[], Any]] = None,
+                 idle_timeout: float = 300.0, check_after: float = 5.0,
+                 devices: Optional[Callable[..., List[dict]]] = None):
+        """
+        Args:
+            transport: Factory for device handles (default: hid.device)
+            idle_timeout: Seconds after which an unused handle is closed
+            check_after: Seconds of idleness after which a handle is checked
+                before it is leased
+            devices: Lists attached keyboards like find_devices(refresh=...),
+                which is the default; used to check and re-find keyboards
+        """
+        self.transport = transport
+        self.find_devices = devices or find_devices
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._devices: Dict[str, PooledDevice] = {}
+        self._lock = threading.Lock()
+
+    def _transport(self) -> Callable[[], Any]:
+        return self.transport or _hid().device
+
+    def lease(self, dev_info: dict, timeout: Optional[float] = None) -> PooledDevice:
+        """
+        Take the handle for an interface, opening it if needed
+
+        The caller owns the handle until release(). Blocks while another
+        user holds it.
+
+        Raises:
+            TimeoutError: If the handle is not released within timeout seconds
+            OSError: If the device cannot be opened
+        """
+        self.evict_idle()
+
+        path = _path_str(dev_info)
+        with self._lock:
+            pooled = self._devices.get(path)
+            if pooled is None:
+                pooled = self._devices[path] = PooledDevice(self, path)
+
+        if not pooled.lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"Device {path} is in use")
+
+        try:
+            pooled.dev_info = dev_info
+            idle = time.monotonic() - pooled.last_used
+            if pooled.handle is None:
+                pooled._open()
+            elif idle > self.check_after and not pooled.healthy():
+                pooled._open()
+        except Exception:
+            pooled.close()
+            pooled.lock.release()
+            raise
+        return pooled
+
+    def _move(self, pooled: PooledDevice, dev_info: dict):
+        """File a leased handle under the path its keyboard now has"""
+        path = _path_str(dev_info)
+        with self._lock:
+            if self._devices.get(pooled.path) is pooled:
+                del self._devices[pooled.path]
+            # A handle already filed under the new path belongs to whichever
+            # keyboard had it before, which is gone from there
+            self._devices[path] = pooled
+        pooled.path = path
+        pooled.dev_info = dev_info
+
+    def release(self, pooled: PooledDevice, healthy: bool = True):
+        """Return a leased handle; an unhealthy one is closed and reopened on next lease"""
+        pooled.last_used = time.monotonic()
+        if not healthy:
+            pooled.close()
+        pooled.lock.release()
+
+    def evict_idle(self):
+        """Close handles that nobody has leased for idle_timeout seconds"""
+        now = time.monotonic()
+        with self._lock:
+            pooled_devices = list(self._devices.values())
+        for pooled in pooled_devices:
+            if pooled.handle is None or now - pooled.last_used < self.idle_timeout:
+                continue
+            # Skip handles in use; they become idle again on release
+            if pooled.lock.acquire(blocking=False):
+                try:
+                    pooled.close()
+                finally:
+                    pooled.lock.release()
+
+    def close(self):
+        """Close every idle handle (leased handles close when released unhealthy)"""
+        with self._lock:
+            pooled_devices = list(self._devices.values())
+        for pooled in pooled_devices:
+            if pooled.lock.acquire(blocking=False):
+                try:
+                    pooled.close()
+                finally:
+                    pooled.lock.release()
+
+    def __len__(self) -> int:
+        """Number of open handles"""
+        with self._lock:
+            return sum(1 for pooled in self._devices.values() if pooled.handle is not None)
+
+
+_shared_pool: Optional[DevicePool] = None
+_shared_pool_lock = threading.Lock()
+
+
+def device_pool() -> DevicePool:
+    """The process-wide DevicePool, created on first use"""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = DevicePool()
+        return _shared_pool
+
+
+class MiniKeyboard:
+    """Interface to the mini keyboard device"""
+
+    def __init__(self, shadow: Optional[ShadowStore] = None,
+                 device_cache: Optional[DeviceInfoCache] = None,
+                 transport: Optional[Callable[[], Any]] = None,
+                 recorder: Optional['CaptureWriter'] = None,
+                 pool: Optional[DevicePool] = None,
+                 journal: Optional[ApplyJournal] = None):
+        """
+        Args:
+            shadow: Record of written state, for incremental applies
+            device_cache: Cache of detected report IDs, to skip probing
+            transport: Factory for the device handle (default: hid.device);
+                the handle must provide open_path, set_nonblocking, write,
+                read and close
+            recorder: Capture file that every packet written is recorded to,
+                for replay_packets()
+            pool: Lease handles from this pool instead of opening the device
+                (e.g. device_pool()); the pool's transport is used
+            journal: Journal writes so an interrupted apply is resumed on
+                the next connect
+        """
+        self.transport = transport
+        self.device: Optional[Any] = None
+        self.device_info: Optional[dict] = None
+        self.encoder = PacketEncoder()  # Report ID defaults to 3, will be detected
+        self.shadow = shadow
+        self.device_cache = device_cache
+        self._report_id_cached = False
+        self.pacer = WritePacer()
+        self._learned_interval: Optional[float] = None
+        self.recorder = recorder
+        self.pool = pool
+        self._lease: Optional[PooledDevice] = None
+        self.journal = journal
+        self.resumed: Optional[Tuple[int, int]] = None     # (packets kept, total) if resumed
+
+    @property
+    def report_id(self) -> int:
+        """Report ID used by the firmware (0, 2 or 3)"""
+        return self.encoder.report_id
+
+    @report_id.setter
+    def report_id(self, value: int):
+        self.encoder.report_id = value
+
+    def find_device(self) -> Optional[dict]:
+        """Find the mini keyboard device - uses MI_01 like vendor software"""
+        devices = find_devices()
+        return devices[0] if devices else None
+
+    def connect(self, dev_info: Optional[dict] = None) -> bool:
+        """
+        Connect to the keyboard
+
+        Args:
+            dev_info: Interface to open (from find_devices()); defaults to
+                the first keyboard found
+        """
+        if dev_info is None:
+            dev_info = self.find_device()
+        if not dev_info:
+            return False
+
+        try:
+            if self.pool is not None:
+                self._lease = self.pool.lease(dev_info)
+                self.device = self._lease.handle
+            else:
+                self.device = self._open(dev_info)
+            self.device_info = dev_info
+
+            # Start from the write interval learned for this model
+            if self.device_cache:
+                self._learned_interval = self.device_cache.write_interval(dev_info.get('product_id', 0))
+                if self._learned_interval is not None:
+                    self.pacer.interval = self._learned_interval
+
+            cached = self.device_cache.report_id(dev_info) if self.device_cache else None
+            if self._lease is not None and self._lease.report_id is not None:
+                # Pooled handle that has been probed before
+                cached = self._lease.report_id
+            if cached is not None:
+                # Known keyboard: skip the probe writes
+                self.report_id = cached
+                self._report_id_cached = True
+            else:
+                self._probe_report_id()
+        except Exception as e:
+            print(f"Failed to open device: {e}")
+            if self._lease is not None:
+                self.pool.release(self._lease, healthy=False)
+                self._lease = None
+            self.device = None
+            return False
+
+        if self.journal is not None:
+            self.resume_pending()
+        return True
+
+    def _open(self, dev_info: dict):
+        """Open a new non-blocking handle on an interface"""
+        device = (self.transport or _hid().device)()
+        device.open_path(dev_info['path'])
+        device.set_nonblocking(True)
+        return device
+
+    def disconnect(self):
+        """Disconnect from the keyboard (or return its handle to the pool)"""
+        if self._lease is not None:
+            self._lease.report_id = self.report_id
+            self.pool.release(self._lease, healthy=self.device is not None)
+            self._lease = None
+        elif self.device:
+            self.device.close()
+        self.device = None
+        self.device_info = None
+        self._report_id_cached = False
+
+    @property
+    def device_key(self) -> Optional[str]:
+        """Identifier of the connected keyboard, used for persistent state"""
+        return device_id(self.device_info) if self.device_info else None
+
+    def pending_mappings(self, mappings: List[KeyMapping]) -> List[KeyMapping]:
+        """Return the mappings that differ from the shadow record of this keyboard"""
+        if self.shadow is None or self.device_key is None:
+            return list(mappings)
+        return self.shadow.changed(self.device_key, mappings)
+
+    def _detect_version(self):
+        """Detect keyboard firmware version by trying different report IDs"""
+        test_data = [0] * 8
+
+        # Try report ID 3 first (most common)
+        for rid in [3, 0, 2]:
+            try:
+                self.device.write([rid] + test_data)
+                self.report_id = rid
+                return
+            except Exception:
+                continue
+
+        # Default to 3 if all fail
+        self.report_id = 3
+
+    def _probe_report_id(self):
+        """Detect the report ID by probing, and remember it for next time"""
+        self._report_id_cached = False
+        if self.device_cache and self.device_info:
+            self.device_cache.forget(self.device_info)
+
+        self._detect_version()
+
+        if self.device_cache and self.device_info:
+            self.device_cache.remember(self.device_info, self.report_id)
+
+    def resume_pending(self) -> bool:
+        """
+        Finish a journaled stream that was interrupted on this keyboard
+
+        Slot writes only survive until the next flash if the keyboard stays
+        powered, so after an unplug or USB reset everything since the last
+        acknowledged flash is gone. Sending therefore restarts right after
+        that flash (journaled streams flash every layer, so the layers
+        already committed are skipped), with the layer switch in effect at
+        that point sent again first. Only the slots committed by
+        acknowledged flashes are recorded in the shadow.
+
+        Returns:
+            True if nothing was pending or the stream was completed
+        """
+        device = self.device_key
+        if not self.device or self.journal is None or device is None:
+            return True
+        pending = self.journal.pending(device)
+        if pending is None:
+            return True
+
+        packets, sent = pending['packets'], pending['sent']
+        if packets and packets[0][0] != self.report_id:
+            if 0 in (packets[0][0], self.report_id):
+                # Layer switching differs between these firmwares: start over
+                self._record_flashed(pending, sent)
+                self.journal.discard(device)
+                return False
+            packets = [bytes([self.report_id]) + packet[1:] for packet in packets]
+
+        flashes = [index for index, packet in enumerate(packets[:sent]) if _is_flash(packet)]
+        start = flashes[-1] + 1 if flashes else 0
+
+        prefix = []
+        if start < len(packets) and not _is_layer_switch(packets[start]):
+            prefix = [packet for packet in packets[:start] if _is_layer_switch(packet)][-1:]
+
+        entry = self.journal.resume(device, start)
+        done = start
+        try:
+            if not all(self._write_packet(packet) for packet in prefix):
+                return False
+            for index in range(start, len(packets)):
+                packet = packets[index]
+                if not self._write_packet(packet):
+                    return False
+                done = index + 1
+                if _is_flash(packet):
+                    entry.ack(done)
+            entry.finish()
+        finally:
+            entry.close()
+            self._record_flashed(pending, done)
+
+        self.resumed = (start, len(packets))
+        return True
+
+    def _record_flashed(self, pending: Dict[str, Any], end: int):
+        """Record in the shadow what the flashes among the first end journaled packets committed"""
+        if self.shadow is None:
+            return
+        committed, led = _flashed(pending['packets'], end)
+        slots = pending.get('slots', {})
+        mappings = [_slot_mapping(key, slots[key]) for key in dict.fromkeys(committed) if key in slots]
+        led_mode = pending.get('led') if led else None
+        if mappings or led_mode is not None:
+            self.shadow.record(self.device_key, mappings, led_mode)
+
+    def _write_stream(self, packets: Sequence[bytes], mappings: Iterable[KeyMapping] = (),
+                      led_mode: Optional[int] = None) -> bool:
+        """
+        Write packets in order, journaling progress if a journal is set
+
+        A journaled stream gets a flash before each layer switch, so an
+        interrupted write resumes after the last layer committed.
+        """
+        if self.journal is None or self.device_key is None:
+            return all(self._write_packet(packet) for packet in packets)
+
+        packets = _with_checkpoints(packets, bytes(self.encoder.flash()))
+        entry = self.journal.begin(self.device_key, packets, mappings, led_mode)
+        try:
+            for index, packet in enumerate(packets, 1):
+                if not self._write_packet(packet):
+                    return False
+                if _is_flash(packet):
+                    entry.ack(index)
+            entry.finish()
+            return True
+        finally:
+            entry.close()
+
+    def _send_packets(self, build, mappings: Iterable[KeyMapping] = (),
+                      led_mode: Optional[int] = None) -> bool:
+        """
+        Write the packet stream returned by build()
+
+        If the report ID came from the device cache and the firmware rejects
+        it, the report ID is probed again and the stream rebuilt and resent
+        once. A pooled handle that fails is reopened first, since it may
+        have gone stale in a USB reset. Either way the failed writes were
+        not congestion, so the pacer goes back to where the stream started
+        rather than learning the interval it widened to.
+        """
+        reopened = False
+        interval = self.pacer.interval
+        while True:
+            from_cache = self._report_id_cached
+            if self._write_stream(build(), mappings, led_mode):
+                self._remember_pacing()
+                return True
+            if self._lease is not None and not reopened:
+                reopened = True
+                self._lease.reopen()
+                self.device = self._lease.handle
+                if self.device:
+                    self.device_info = self._lease.dev_info
+                    self.pacer.reset(interval)
+                    continue
+                return False
+            if not from_cache:
+                return False
+            self._probe_report_id()
+            self.pacer.reset(interval)
+
+    def _remember_pacing(self):
+        """Persist the pacer's interval for this model once it has changed"""
+        interval = self.pacer.interval
+        if (self.device_cache and self.device_info
+                and interval != (self._learned_interval or 0.0)):
+            self.device_cache.remember_write_interval(self.device_info.get('product_id', 0), interval)
+            self._learned_interval = interval
+
+    def _write_packet(self, packet: Sequence[int]) -> bool:
+        """Write a complete packet (report ID + 8-byte report) to the device"""
+        if not self.device:
+            return False
+
+        pacer = self.pacer
+        for attempt in range(pacer.max_retries + 1):
+            pacer.wait()
+            start = time.perf_counter()
+            try:
+                written = self.device.write(packet)
+                if written is not None and written < 0:
+                    raise OSError("device rejected the write")
+            except Exception as e:
+                error = e
+                if attempt < pacer.max_retries:
+                    pacer.failure(attempt)
+                continue
+
+            pacer.success(time.perf_counter() - start)
+            if self.recorder is not None:
+                self.recorder.write_packet(time.time(), RECORD_INTERFACE, packet)
+            return True
+
+        print(f"Write failed: {error}")
+        return False
+
+    def _write_report(self, data: List[int]) -> bool:
+        """Write an 8-byte report to the device"""
+        return self._write_packet(self.encoder.report(data))
+
+    def _send_layer_switch(self, layer: int) -> bool:
+        """Send layer switch command"""
+        return self._write_packet(self.encoder.layer_switch(layer))
+
+    def _send_flash_command(self, is_led: bool = False) -> bool:
+        """Send command to write configuration to flash"""
+        return self._write_packet(self.encoder.flash(is_led))
+
+    def apply_profile(self, mappings: List[KeyMapping], incremental: bool = False) -> bool:
+        """
+        Write a batch of key mappings and commit them with a single flash
+
+        Mappings are grouped by layer, so one layer switch (0xA1) is sent per
+        layer and one flash command (0xAA/0xAA) is sent for the whole batch,
+        instead of a layer switch and a flash for every key.
+
+        Args:
+            mappings: Basic, media or mouse key mappings to write
+            incremental: Only write mappings that differ from the shadow
+                record, and skip the flash when nothing differs
+
+        Raises:
+            ValueError: If a mapping does not fit its packet (nothing is written)
+        """
+        if not self.device:
+            return False
+
+        if incremental:
+            mappings = self.pending_mappings(mappings)
+
+        if not mappings:
+            return True
+
+        # The whole stream is compiled before the first write, so an invalid
+        # mapping fails before anything is sent to the device
+        if not self._send_packets(lambda: self.encoder.compile(mappings), mappings):
+            return False
+
+        if self.shadow is not None and self.device_key is not None:
+            self.shadow.record(self.device_key, mappings)
+        return True
+
+    def apply_transition(self, plan: TransitionPlan) -> bool:
+        """
+        Switch the keyboard between profiles using a precomputed plan
+
+        The plan assumes the keyboard holds its source profile. If the
+        shadow record shows otherwise, the target profile is applied
+        incrementally instead.
+        """
+        if not self.device:
+            return False
+
+        tracked = self.shadow is not None and self.device_key is not None
+        target = plan.target_profile
+        if tracked and target is not None and self.shadow.get(self.device_key) is not None:
+            # Trust the shadow record over the plan's assumed starting point
+            pending = self.shadow.changed(self.device_key, target.mappings)
+            led_pending = (target.led_mode is not None
+                           and self.shadow.led_mode(self.device_key) != target.led_mode)
+            if pending != plan.mappings or led_pending != (plan.led_mode is not None):
+                return (self.apply_profile(pending)
+                        and (not led_pending or self.set_led_mode(target.led_mode)))
+
+        if plan.mappings or plan.led_mode is not None:
+            if not self._send_packets(lambda: plan.packets(self.report_id), plan.mappings, plan.led_mode):
+                return False
+
+        if tracked:
+            self.shadow.record(self.device_key, plan.mappings, plan.led_mode)
+        return True
+
+    def set_basic_key(self, physical_key: int, keycode: int,
+                      modifiers: int = 0, layer: int = 1) -> bool:
+        """
+        Configure a physical key to send a basic keyboard key
+
+        Args:
+            physical_key: Physical key number (1-18)
+            keycode: USB HID keycode
+            modifiers: Modifier flags (Ctrl=1, Shift=2, Alt=4, Win=8)
+            layer: Layer number (1-3)
+        """
+        return self.apply_profile([
+            KeyMapping(physical_key, KeyType.BASIC, modifiers, keycode, layer)
+        ])
+
+    def set_media_key(self, physical_key: int, media_keycode: int,
+                      layer: int = 1) -> bool:
+        """
+        Configure a physical key to send a media key
+
+        Args:
+            physical_key: Physical key number (1-18)
+            media_keycode: Media key code
+            layer: Layer number (1-3)
+        """
+        return self.apply_profile([
+            KeyMapping(physical_key, KeyType.MEDIA, keycode=media_keycode, layer=layer)
+        ])
+
+    def set_mouse_key(self, physical_key: int, buttons: int = 0, dx: int = 0, dy: int = 0,
+                      wheel: int = 0, modifiers: int = 0, layer: int = 1) -> bool:
+        """
+        Configure a physical key to send a mouse action
+
+        Args:
+            physical_key: Physical key number (1-18)
+            buttons: Button mask (left=1, right=2, middle=4)
+            dx: Horizontal movement (-128..127)
+            dy: Vertical movement (-128..127)
+            wheel: Wheel steps (positive = up, -128..127)
+            modifiers: Modifier flags held during the action (Ctrl=1, Shift=2, Alt=4)
+            layer: Layer number (1-3)
+        """
+        return self.apply_profile([
+            KeyMapping(physical_key, KeyType.MOUSE, modifiers, buttons, layer,
+                       dx=dx, dy=dy, wheel=wheel)
+        ])
+
+    def set_key_sequence(self, physical_key: int, combos: List[Any],
+                         layer: int = 1) -> bool:
+        """
+        Configure a physical key to type a sequence of key combinations
+
+        Args:
+            physical_key: Physical key number (1-18)
+            combos: Up to 5 keystrokes, each a combo string like 'ctrl+c' or
+                a (modifiers, keycode) tuple
+            layer: Layer number (1-3)
+        """
+        return self.apply_profile([key_sequence_mapping(physical_key, combos, layer)])
+
+    def set_led_mode(self, mode: int, incremental: bool = False) -> bool:
+        """
+        Set LED mode
+
+        Args:
+            mode: LED mode (0=off, 1=on, 2=breathing, etc.)
+            incremental: Skip the write if the shadow record already has this mode
+
+        Raises:
+            ValueError: If mode is outside 0-255
+        """
+        if not self.device:
+            return False
+
+        tracked = self.shadow is not None and self.device_key is not None
+        if incremental and tracked and self.shadow.led_mode(self.device_key) == mode:
+            return True
+
+        if not self._send_packets(lambda: self.encoder.compile_led(mode), led_mode=mode):
+            return False
+
+        if tracked:
+            self.shadow.record(self.device_key, led_mode=mode)
+        return True
+
+    def is_connected(self) -> bool:
+        """Check if device is connected"""
+        return self.device is not None
+
+
+class SimulatedKeyboard:
+    """
+    In-memory model of the keyboard firmware, usable as a MiniKeyboard transport
+
+    Implements the hid.device calls the library uses and decodes writes the
+    way the firmware does (see docs/PROTOCOL.md): only configured report IDs
+    are accepted, 0xA1 selects the layer, key packets go to a pending slot
+    table and 0xAA commits the pending slots (or LED mode) to "flash".
+    Closing the handle drops whatever was not flashed, as an unplug does.
+
+    Example:
+        sim = SimulatedKeyboard(write_latency=0.001)
+        kb = MiniKeyboard(transport=sim.transport)
+        kb.connect(sim.device_info)
+    """
+
+    def __init__(self, report_ids: Iterable[int] = (3,), product_id: int = 0x8890,
+                 serial: str = 'SIM0001', path: bytes = b'sim:0',
+                 write_latency: float = 0.0, error_rate: float = 0.0,
+                 fail_writes: Iterable[int] = (), apply_writes: bool = True,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            report_ids: Report IDs the firmware accepts (writes with others fail)
+            product_id: PID reported in device_info
+            serial: Serial number reported in device_info
+            path: Path reported in device_info
+            write_latency: Seconds each write blocks for
+            error_rate: Probability (0-1) that a write fails
+            fail_writes: Zero-based write numbers that fail
+            apply_writes: False models the 0x8840 variant, which accepts
+                writes but never applies them
+            seed: Seed for the error injection random generator
+        """
+        import random
+
+        self.report_ids = set(report_ids)
+        self.product_id = product_id
+        self.serial = serial
+        self.path = path
+        self.write_latency = write_latency
+        self.error_rate = error_rate
+        self.fail_writes = set(fail_writes)
+        self.apply_writes = apply_writes
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._input: List[bytes] = []
+        self._input_ready = threading.Condition(self._lock)
+
+        self.is_open = False
+        self.layer = 1
+        self.pending: Dict[Tuple[int, int], Dict[int, bytes]] = {}
+        self.slots: Dict[Tuple[int, int], Dict[int, bytes]] = {}
+        self.pending_led: Optional[int] = None
+        self.led_mode: Optional[int] = None
+        self.write_count = 0
+        self.flash_count = 0
+        self.packets: List[bytes] = []
+
+    @property
+    def device_info(self) -> dict:
+        """Enumeration entry for this keyboard, to pass to MiniKeyboard.connect()"""
+        return {
+            'path': self.path, 'vendor_id': VENDOR_ID, 'product_id': self.product_id,
+            'serial_number': self.serial, 'interface_number': 0,
+            'usage_page': 0xff00, 'usage': 1,
+            'manufacturer_string': 'turbokeys', 'product_string': 'Simulated keyboard',
+        }
+
+    def transport(self) -> 'SimulatedKeyboard':
+        """Transport factory: every MiniKeyboard handle talks to this keyboard"""
+        return self
+
+    def find_devices(self, refresh: bool = False) -> List[dict]:
+        """Enumerator for DevicePool(devices=...): lists only this keyboard"""
+        return [self.device_info]
+
+    # hid.device interface
+
+    def open_path(self, path):
+        self.is_open = True
+
+    def set_nonblocking(self, nonblocking):
+        pass
+
+    def close(self):
+        # Like an unplug: writes not yet flashed are lost and the layer resets
+        self.is_open = False
+        with self._lock:
+            self.pending = {}
+            self.pending_led = None
+            self.layer = 1
+
+    def write(self, data: Sequence[int]) -> int:
+        if not self.is_open:
+            raise OSError("Simulated keyboard is not open")
+
+        if self.write_latency:
+            time.sleep(self.write_latency)
+
+        with self._lock:
+            index = self.write_count
+            self.write_count += 1
+
+            if index in self.fail_writes or (self.error_rate and self._random.random() < self.error_rate):
+                raise OSError(f"Simulated write error (write {index})")
+
+            if not data or data[0] not in self.report_ids:
+                raise OSError(f"Report ID {data[0] if data else None} not accepted")
+
+            packet = bytes(data[:PACKET_SIZE]).ljust(PACKET_SIZE, b'\0')
+            self.packets.append(packet)
+            if self.apply_writes:
+                self._handle(packet[0], packet[1:])
+
+        return len(data)
+
+    def get_product_string(self) -> str:
+        if not self.is_open:
+            raise OSError("Simulated keyboard is not open")
+        return self.device_info['product_string']
+
+    def read(self, size: int, timeout_ms: int = 0) -> List[int]:
+        with self._input_ready:
+            if not self._input and timeout_ms:
+                self._input_ready.wait(timeout_ms / 1000.0 if timeout_ms > 0 else None)
+            if not self._input:
+                return []
+            return list(self._input.pop(0)[:size])
+
+    # Simulation helpers
+
+    def feed_input(self, data: Sequence[int]):
+        """Queue an input report to be returned by read()"""
+        with self._input_ready:
+            self._input.append(bytes(data))
+            self._input_ready.notify()
+
+    def _handle(self, report_id: int, report: bytes):
+        command = report[0]
+
+        if command == 0xA1:
+            self.layer = max(report[1], 1)
+
+        elif command == 0xAA:
+            if report[1] == 0xA1:
+                if self.pending_led is not None:
+                    self.led_mode = self.pending_led
+                    self.pending_led = None
+            else:
+                self.slots.update(self.pending)
+                self.pending = {}
+            self.flash_count += 1
+
+        elif command == 0xB0 and report[1] & 0x0F == KeyType.LED:
+            self.pending_led = report[2]
+
+        elif 1 <= command <= 18:
+            # v0 firmware has no layers; v2/v3 carry the layer in the type byte
+            layer = ((report[1] >> 4) or self.layer) if report_id != 0 else 1
+            slot = self.pending.setdefault((layer, command), {})
+            index = report[3] if report[1] & 0x0F == KeyType.BASIC else 0
+            if index == 0:
+                slot.clear()
+            slot[index] = report
+
+    def mapping(self, physical_key: int, layer: int = 1) -> Optional[KeyMapping]:
+        """Decode the flashed configuration of a key, if it has been written"""
+        packets = self.slots.get((layer, physical_key))
+        if not packets:
+            return None
+
+        report = packets[0]
+        key_type = KeyType(report[1] & 0x0F)
+        if key_type == KeyType.MEDIA:
+            return KeyMapping(physical_key, key_type, keycode=report[2] | (report[3] << 8), layer=layer)
+
+        if key_type == KeyType.MOUSE:
+            dx, dy, wheel = struct.unpack_from('<3b', report, 3)
+            return KeyMapping(physical_key, key_type, report[6], report[2], layer,
+                              dx=dx, dy=dy, wheel=wheel)
+
+        if len(packets) > 1:
+            sequence = tuple((packets[i][4], packets[i][5]) for i in sorted(packets) if i > 0)
+            return KeyMapping(physical_key, key_type, sequence[0][0], sequence[0][1], layer, sequence)
+        return KeyMapping(physical_key, key_type, report[4], report[5], layer)
+
+
+@dataclass
+class FleetResult:
+    """Outcome of programming one keyboard in a fleet run"""
+    device: str
+    ok: bool
+    written: int = 0
+    error: str = ''
+    elapsed: float = 0.0
+
+
+class Fleet:
+    """
+    Programs every attached keyboard concurrently
+
+    Each keyboard gets its own MiniKeyboard connection on a worker thread,
+    so USB round trips to different keyboards overlap.
+    """
+
+    def __init__(self, max_workers: int = 16, shadow: Optional[ShadowStore] = None,
+                 device_cache: Optional[DeviceInfoCache] = None,
+                 journal: Optional[ApplyJournal] = None):
+        self.max_workers = max_workers
+        self.shadow = shadow
+        self.device_cache = device_cache
+        self.journal = journal
+
+    def discover(self) -> List[dict]:
+        """Return the configuration interface of every attached keyboard"""
+        return find_devices()
+
+    def apply(self, profile: Profile, incremental: bool = True,
+              devices: Optional[List[dict]] = None,
+              callback=None) -> List[FleetResult]:
+        """
+        Apply a profile to every keyboard
+
+        Args:
+            profile: Profile to apply
+            incremental: Only write what differs from each keyboard's shadow record
+            devices: Interfaces to program (default: all attached keyboards)
+            callback: Called with each FleetResult as soon as it completes
+
+        Returns:
+            One FleetResult per device, in the order of devices
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if devices is None:
+            devices = self.discover()
+        if not devices:
+            return []
+
+        def run(dev_info: dict) -> FleetResult:
+            result = self.apply_device(dev_info, profile, incremental)
+            if callback:
+                callback(result)
+            return result
+
+        workers = max(1, min(self.max_workers, len(devices)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='turbokeys') as pool:
+            return list(pool.map(run, devices))
+
+    def apply_device(self, dev_info: dict, profile: Profile,
+                     incremental: bool = True) -> FleetResult:
+        """
+        Apply a profile to one keyboard, e.g. one that was just plugged in
+
+        Args:
+            dev_info: Configuration interface of the keyboard
+            profile: Profile to apply
+            incremental: Only write what differs from the keyboard's shadow record
+
+        Returns:
+            FleetResult for the keyboard; errors are reported there, not raised
+        """
+        start = time.perf_counter()
+        result = FleetResult(device=device_id(dev_info), ok=False)
+
+        kb = MiniKeyboard(shadow=self.shadow, device_cache=self.device_cache, journal=self.journal)
+        if not kb.connect(dev_info):
+            result.error = "could not open device"
+        else:
+            try:
+                pending = kb.pending_mappings(profile.mappings) if incremental else profile.mappings
+                if not kb.apply_profile(pending):
+                    result.error = "key write failed"
+                elif profile.led_mode is not None and not kb.set_led_mode(profile.led_mode, incremental):
+                    result.error = "LED write failed"
+                else:
+                    result.ok = True
+                    result.written = len(pending)
+            except Exception as e:
+                result.error = str(e)
+            finally:
+                kb.disconnect()
+
+        result.elapsed = time.perf_counter() - start
+        return result
+
+
+# Linux kernel uevent multicast group
+_NETLINK_KOBJECT_UEVENT = 15
+
+
+class HotplugWatcher:
+    """
+    Reports keyboards (configuration interfaces) as they are plugged in and out
+
+    On Linux the watcher sleeps on a netlink uevent socket and only looks at
+    the USB bus when a hidraw node is added or removed. Where netlink is not
+    available it polls the cheap /sys/class/hidraw listing, and only on
+    systems without hidraw does it fall back to enumerating every
+    poll_interval seconds.
+
+    Example:
+        watcher = HotplugWatcher(on_added=lambda dev: print("plugged", device_id(dev)))
+        watcher.start()
+    """
+
+    # Wait for the rest of a keyboard's interfaces after the first appears
+    SETTLE_TIME = 0.3
+
+    def __init__(self, on_added: Callable[[dict], None],
+                 on_removed: Optional[Callable[[dict], None]] = None,
+                 poll_interval: float = 1.0):
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.poll_interval = poll_interval
+        self.devices: Dict[str, dict] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _open_netlink(self):
+        import socket
+
+        if not hasattr(socket, 'AF_NETLINK'):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, _NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            return sock
+        except OSError:
+            return None
+
+    def _wait_netlink(self, sock) -> bool:
+        """Wait for a hidraw uevent; returns True if one arrived"""
+        import select
+
+        readable, _, _ = select.select([sock], [], [], self.poll_interval)
+        changed = False
+        while readable:
+            try:
+                message = sock.recv(8192)
+            except OSError:
+                break
+            changed = changed or b'SUBSYSTEM=hidraw' in message
+            readable, _, _ = select.select([sock], [], [], 0)
+        return changed
+
+    def scan(self):
+        """Enumerate now and report the keyboards added or removed since the last scan"""
+        found = {device_id(dev_info): dev_info for dev_info in find_devices(refresh=True)}
+
+        for key in [key for key in self.devices if key not in found]:
+            dev_info = self.devices.pop(key)
+            if self.on_removed:
+                self.on_removed(dev_info)
+        for key, dev_info in found.items():
+            if key not in self.devices:
+                self.devices[key] = dev_info
+                self.on_added(dev_info)
+
+    def run(self, initial: bool = True):
+        """
+        Watch until stop() is called
+
+        Args:
+            initial: Report the keyboards already attached as added
+        """
+        if initial:
+            self.scan()
+        else:
+            self.devices = {device_id(dev_info): dev_info for dev_info in find_devices(refresh=True)}
+
+        sock = self._open_netlink()
+        signature = _hotplug_signature()
+        try:
+            while not self._stop.is_set():
+                if sock is not None:
+                    changed = self._wait_netlink(sock)
+                else:
+                    self._stop.wait(self.poll_interval)
+                    current = _hotplug_signature()
+                    changed = current is None or current != signature
+                    signature = current
+
+                if changed and not self._stop.is_set():
+                    self._stop.wait(self.SETTLE_TIME)
+                    self.scan()
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def start(self, initial: bool = True):
+        """Run the watcher on a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(initial,),
+                                        name='turbokeys-hotplug', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.poll_interval + self.SETTLE_TIME + 1.0)
+            self._thread = None
+
+
+class AsyncMiniKeyboard:
+    """
+    asyncio wrapper around MiniKeyboard
+
+    Blocking hidapi calls run on a single worker thread per keyboard, so
+    calls to one device stay ordered while many devices can be driven
+    concurrently with asyncio.gather(). Every operation accepts a timeout
+    (falling back to the one given here); on timeout or cancellation the
+    awaiting coroutine is released, but a USB write already in progress
+    finishes on the worker thread.
+
+    Example:
+        async with AsyncMiniKeyboard(timeout=5) as kb:
+            await kb.apply_profile(profile.mappings)
+    """
+
+    def __init__(self, keyboard: Optional[MiniKeyboard] = None,
+                 timeout: Optional[float] = None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.keyboard = keyboard or MiniKeyboard()
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='turbokeys-async')
+
+    async def _call(self, timeout: Optional[float], func, *args):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, func, *args)
+        return await asyncio.wait_for(future, timeout if timeout is not None else self.timeout)
+
+    async def connect(self, dev_info: Optional[dict] = None,
+                      timeout: Optional[float] = None) -> bool:
+        """Connect to the keyboard (see MiniKeyboard.connect)"""
+        return await self._call(timeout, self.keyboard.connect, dev_info)
+
+    async def disconnect(self, timeout: Optional[float] = None):
+        """Disconnect from the keyboard"""
+        await self._call(timeout, self.keyboard.disconnect)
+
+    async def close(self):
+        """Disconnect and shut down the worker thread"""
+        try:
+            await self.disconnect()
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def apply_profile(self, mappings: List[KeyMapping], incremental: bool = False,
+                            timeout: Optional[float] = None) -> bool:
+        """Write a batch of key mappings with a single flash (see MiniKeyboard.apply_profile)"""
+        return await self._call(timeout, self.keyboard.apply_profile, mappings, incremental)
+
+    async def set_basic_key(self, physical_key: int, keycode: int, modifiers: int = 0,
+                            layer: int = 1, timeout: Optional[float] = None) -> bool:
+        """Configure a physical key to send a basic keyboard key"""
+        return await self._call(timeout, self.keyboard.set_basic_key,
+                                physical_key, keycode, modifiers, layer)
+
+    async def set_media_key(self, physical_key: int, media_keycode: int, layer: int = 1,
+                            timeout: Optional[float] = None) -> bool:
+        """Configure a physical key to send a media key"""
+        return await self._call(timeout, self.keyboard.set_media_key,
+                                physical_key, media_keycode, layer)
+
+    async def set_mouse_key(self, physical_key: int, buttons: int = 0, dx: int = 0, dy: int = 0,
+                            wheel: int = 0, modifiers: int = 0, layer: int = 1,
+                            timeout: Optional[float] = None) -> bool:
+        """Configure a physical key to send a mouse action"""
+        return await self._call(timeout, self.keyboard.set_mouse_key,
+                                physical_key, buttons, dx, dy, wheel, modifiers, layer)
+
+    async def set_key_sequence(self, physical_key: int, combos: List[Any], layer: int = 1,
+                               timeout: Optional[float] = None) -> bool:
+        """Configure a physical key to type a sequence of key combinations"""
+        return await self._call(timeout, self.keyboard.set_key_sequence,
+                                physical_key, combos, layer)
+
+    async def set_led_mode(self, mode: int, incremental: bool = False,
+                           timeout: Optional[float] = None) -> bool:
+        """Set LED mode"""
+        return await self._call(timeout, self.keyboard.set_led_mode, mode, incremental)
+
+    def is_connected(self) -> bool:
+        """Check if device is connected"""
+        return self.keyboard.is_connected()
+
+    async def __aenter__(self) -> 'AsyncMiniKeyboard':
+        if not await self.connect():
+            self._executor.shutdown(wait=False)
+            raise ConnectionError("Could not connect to keyboard")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+def parse_key_combo(combo_str: str) -> Tuple[int, int]:
+    """
+    Parse a key combination string like 'ctrl+shift+a' into modifiers and keycode
+
+    Returns:
+        Tuple of (modifiers, keycode)
+    """
+    modifiers, keycode, _ = _parse_combo(combo_str)
+    return modifiers, keycode
+
+
+def _parse_combo(combo_str: str) -> Tuple[int, int, bool]:
+    """
+    parse_key_combo(), plus whether the combo was valid: every part is a
+    modifier, a key name or a hex keycode ('0x48'), and there is at least one
+    """
+    parts = combo_str.lower().replace(' ', '').split('+')
+    modifiers = 0
+    keycode = 0
+    valid = True
+
+    for part in parts:
+        if part in MODIFIER_ALIASES:
+            modifiers |= MODIFIER_ALIASES[part]
+        elif part in KEYCODES:
+            keycode = KEYCODES[part]
+        elif re.fullmatch(r'0x[0-9a-f]{1,2}', part):
+            keycode = int(part, 16)
+        else:
+            valid = False
+
+    return modifiers, keycode, valid
+
+
+def format_key_combo(modifiers: int, keycode: int) -> str:
+    """Format modifiers and a keycode as a combo string like 'ctrl+shift+a'"""
+    parts = [name for flag, name in MODIFIER_NAMES if modifiers & flag]
+    if keycode or not parts:
+        name = KEYCODE_NAMES[keycode] if 0 <= keycode < 256 else None
+        # Modifier usages (0xE0-0xE7) are named for decoding but read as modifiers here
+        parts.append(name if name and KEYCODES.get(name) == keycode else f"0x{keycode:02x}")
+    return '+'.join(parts)
+
+
+def format_mapping(mapping: KeyMapping) -> str:
+    """Format a key mapping as the string parse_mapping() accepts"""
+    if mapping.key_type == KeyType.MEDIA:
+        return MEDIA_KEYCODE_NAMES.get(mapping.keycode) or f"media:0x{mapping.keycode:02x}"
+
+    if mapping.key_type == KeyType.MOUSE:
+        actions = [name for bit, name in MOUSE_BUTTON_NAMES.items() if mapping.keycode & bit]
+        unnamed = mapping.keycode & ~sum(MOUSE_BUTTON_NAMES)
+        if unnamed:
+            actions.append(f"buttons:0x{unnamed:02x}")
+        if mapping.wheel == 1:
+            actions.append('wheelup')
+        elif mapping.wheel == -1:
+            actions.append('wheeldown')
+        elif mapping.wheel:
+            actions.append(f"wheel:{mapping.wheel}")
+        if mapping.dx or mapping.dy or not actions:
+            # move:0:0 also marks a mouse key that does nothing as a mouse key
+            actions.append(f"move:{mapping.dx}:{mapping.dy}")
+        return '+'.join([name for flag, name in MODIFIER_NAMES if mapping.modifiers & flag] + actions)
+
+    if len(mapping.sequence) > 1:
+        return ','.join(format_key_combo(mods, code) for mods, code in mapping.sequence)
+
+    modifiers, keycode = mapping.sequence[0] if mapping.sequence else (mapping.modifiers, mapping.keycode)
+    return format_key_combo(modifiers, keycode)
+
+
+def parse_mapping(key_name: str, mapping_str: str, layer: int = 1) -> KeyMapping:
+    """
+    Parse a physical key name and a mapping string like 'ctrl+c' or 'volup'
+
+    Raises:
+        ValueError: If the physical key, layer or mapping is not recognised
+    """
+    name = key_name.lower()
+    if name not in PHYSICAL_KEYS:
+        raise ValueError(f"Unknown physical key '{key_name}'\n"
+                         f"Valid keys: {', '.join(sorted(PHYSICAL_KEYS.keys()))}")
+
+    if not 1 <= layer <= 3:
+        raise ValueError(f"Invalid layer {layer} (must be 1-3)")
+
+    physical_key = PHYSICAL_KEYS[name]
+    mapping = mapping_str.lower()
+
+    # Check if it's a media key, by name or as media:<code>
+    if mapping in MEDIA_KEYCODES:
+        return KeyMapping(physical_key, KeyType.MEDIA,
+                          keycode=MEDIA_KEYCODES[mapping], layer=layer)
+    if mapping.startswith('media:'):
+        try:
+            code = int(mapping[6:], 0)
+        except ValueError:
+            code = -1
+        if not 0 <= code <= 0xFFFF:
+            raise ValueError(f"Invalid media code '{mapping_str}' (use media:<0-0xffff>)")
+        return KeyMapping(physical_key, KeyType.MEDIA, keycode=code, layer=layer)
+
+    # Check if it's a mouse action
+    mouse = parse_mouse_action(mapping)
+    if mouse is not None:
+        buttons, dx, dy, wheel, modifiers = mouse
+        return KeyMapping(physical_key, KeyType.MOUSE, modifiers, buttons, layer,
+                          dx=dx, dy=dy, wheel=wheel)
+
+    # Comma-separated combos form a macro ('ctrl+c,ctrl+v'); a lone ','
+    # is the comma key
+    if ',' in mapping and mapping != ',':
+        return key_sequence_mapping(physical_key, mapping.split(','), layer)
+
+    # Parse as basic key combo (a modifier on its own is a valid mapping)
+    modifiers, keycode, valid = _parse_combo(mapping)
+    if not valid:
+        raise ValueError(f"Unknown key '{mapping_str}'\n"
+                         f"Valid keys: {', '.join(sorted(KEYCODES.keys()))}")
+
+    return KeyMapping(physical_key, KeyType.BASIC, modifiers, keycode, layer)
+
+
+def parse_mouse_action(action_str: str) -> Optional[Tuple[int, int, int, int, int]]:
+    """
+    Parse a mouse action like 'lclick', 'ctrl+wheelup', 'move:10:-5', 'wheel:3'
+    or 'buttons:0x08'
+
+    Returns:
+        Tuple of (buttons, dx, dy, wheel, modifiers), or None if the string
+        is not a mouse action
+
+    Raises:
+        ValueError: If a movement value is not a number in -128..127
+    """
+    parts = action_str.lower().replace(' ', '').split('+')
+    buttons = dx = dy = wheel = modifiers = 0
+    is_mouse = False
+
+    for part in parts:
+        if part in MODIFIER_ALIASES:
+            modifiers |= MODIFIER_ALIASES[part]
+        elif part in MOUSE_BUTTONS:
+            buttons |= MOUSE_BUTTONS[part]
+            is_mouse = True
+        elif part.startswith('buttons:'):
+            try:
+                buttons |= int(part[8:], 0)
+            except ValueError:
+                raise ValueError(f"Invalid mouse buttons '{part}'") from None
+            if not 0 <= buttons <= 0xFF:
+                raise ValueError(f"Mouse buttons {part} out of range (0..0xff)")
+            is_mouse = True
+        elif part in MOUSE_WHEEL:
+            wheel = MOUSE_WHEEL[part]
+            is_mouse = True
+        elif part.startswith(('move:', 'wheel:')):
+            name, _, values = part.partition(':')
+            try:
+                numbers = [int(v) for v in values.split(':')]
+            except ValueError:
+                raise ValueError(f"Invalid mouse {name} '{part}'") from None
+            if name == 'move' and len(numbers) == 2:
+                dx, dy = numbers
+            elif name == 'wheel' and len(numbers) == 1:
+                wheel = numbers[0]
+            else:
+                raise ValueError(f"Use move:<dx>:<dy> or wheel:<steps>, not '{part}'")
+            is_mouse = True
+        else:
+            return None
+
+    if not is_mouse:
+        return None
+
+    for value in (dx, dy, wheel):
+        if not -128 <= value <= 127:
+            raise ValueError(f"Mouse movement {value} out of range (-128..127)")
+
+    return buttons, dx, dy, wheel, modifiers
+
+
+def key_sequence_mapping(physical_key: int, combos: List[Any], layer: int = 1) -> KeyMapping:
+    """
+    Build a macro mapping from combo strings ('ctrl+c') or (modifiers, keycode) tuples
+
+    Raises:
+        ValueError: If a combo is not recognised or there are too many keys
+    """
+    steps = []
+    for combo in combos:
+        if isinstance(combo, str):
+            modifiers, keycode, valid = _parse_combo(combo)
+            if not valid:
+                raise ValueError(f"Unknown key '{combo}' in key sequence "
+                                 f"(use 'comma' for the comma key)")
+        else:
+            modifiers, keycode = combo
+        steps.append((int(modifiers), int(keycode)))
+
+    if not 1 <= len(steps) <= MAX_SEQUENCE_LENGTH:
+        raise ValueError(f"Key sequence needs 1-{MAX_SEQUENCE_LENGTH} keys, got {len(steps)}")
+
+    if len(steps) == 1:
+        return KeyMapping(physical_key, KeyType.BASIC, steps[0][0], steps[0][1], layer)
+
+    return KeyMapping(physical_key, KeyType.BASIC, steps[0][0], steps[0][1], layer, tuple(steps))
+
+
+def profile_from_dict(data: Dict[str, Any]) -> Profile:
+    """
+    Build a Profile from parsed profile data
+
+    Expected structure (shown as TOML)::
+
+        led = 1
+
+        [layers.1]
+        key1 = "ctrl+c"
+        knob1_cw = "volup"
+
+        [layers.2]
+        key1 = "f5"
+
+    Raises:
+        ValueError: If the data does not describe a valid profile
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Profile must be a table/object at the top level")
+
+    unknown = set(data) - {'led', 'layers'}
+    if unknown:
+        raise ValueError(f"Unknown profile field(s): {', '.join(sorted(unknown))}")
+
+    profile = Profile()
+
+    led = data.get('led')
+    if led is not None:
+        if isinstance(led, bool) or not isinstance(led, int) or not 0 <= led <= 255:
+            raise ValueError(f"Invalid LED mode {led!r}. Must be 0-255")
+        profile.led_mode = led
+
+    layers = data.get('layers', {})
+    if not isinstance(layers, dict):
+        raise ValueError("'layers' must map layer numbers to key tables")
+
+    seen = set()
+    for layer_key in sorted(layers, key=str):
+        try:
+            layer = int(layer_key)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid layer '{layer_key}'") from None
+
+        keys = layers[layer_key] or {}
+        if not isinstance(keys, dict):
+            raise ValueError(f"Layer {layer} must map physical keys to mappings")
+
+        for key_name, mapping_str in keys.items():
+            # A list of combos is a macro, same as 'ctrl+c,ctrl+v'
+            if isinstance(mapping_str, list):
+                mapping_str = ','.join(str(combo) for combo in mapping_str)
+            mapping = parse_mapping(str(key_name), str(mapping_str), layer)
+
+            # Aliases like k1_left/knob1_ccw name the same physical key
+            slot = (mapping.layer, mapping.physical_key)
+            if slot in seen:
+                raise ValueError(f"Duplicate mapping for physical key "
+                                 f"{mapping.physical_key} on layer {layer}")
+            seen.add(slot)
+
+            profile.mappings.append(mapping)
+
+    return profile
+
+
+def profile_to_dict(profile: Profile) -> Dict[str, Any]:
+    """Export a Profile in the structure profile_from_dict() reads"""
+    data: Dict[str, Any] = {}
+    if profile.led_mode is not None:
+        data['led'] = profile.led_mode
+
+    layers: Dict[str, Dict[str, str]] = {}
+    for mapping in sorted(profile.mappings, key=lambda m: (m.layer, m.physical_key)):
+        keys = layers.setdefault(str(mapping.layer), {})
+        keys[physical_key_name(mapping.physical_key)] = format_mapping(mapping)
+    data['layers'] = layers
+    return data
+
+
+def load_profile(path: str) -> Profile:
+    """
+    Load a profile from a TOML, JSON or YAML file
+
+    TOML needs Python 3.11+ (or the tomli package), YAML needs PyYAML.
+
+    Raises:
+        ValueError: If the file format is unsupported or the profile is invalid
+    """
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext == '.json':
+        import json
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    elif ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ValueError("TOML profiles need Python 3.11+ or: pip install tomli") from None
+        with open(path, 'rb') as f:
+            data = tomllib.load(f)
+    elif ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAML profiles need PyYAML: pip install pyyaml") from None
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid YAML: {e}") from None
+    else:
+        raise ValueError(f"Unsupported profile format '{ext}' (use .toml, .json, .yaml or .yml)")
+
+    return profile_from_dict(data)
+
+
+def list_devices():
+    """List all connected mini keyboards"""
+    devices = enumerate_devices()
+
+    if not devices:
+        print("No mini keyboard devices found")
+        print(f"Looking for VID=0x{VENDOR_ID:04x} with PIDs: {', '.join(f'0x{p:04x}' for p in PRODUCT_IDS)}")
+        return
+
+    print(f"Found {len(devices)} device interface(s):")
+    for dev in devices:
+        print(f"  Path: {dev['path']}")
+        print(f"  VID:PID = 0x{dev['vendor_id']:04x}:0x{dev['product_id']:04x}")
+        print(f"  Manufacturer: {dev.get('manufacturer_string', 'N/A')}")
+        print(f"  Product: {dev.get('product_string', 'N/A')}")
+        print(f"  Interface: {dev.get('interface_number', 'N/A')}")
+        print(f"  Usage Page: 0x{dev.get('usage_page', 0):04x}")
+        print(f"  Usage: 0x{dev.get('usage', 0):04x}")
+        print(f"  Device ID: {', '.join(device_keys(dev))}")
+        print()
+
+
+@dataclass
+class InputReport:
+    """A raw report read from one keyboard interface"""
+    timestamp: float
+    interface: int
+    data: bytes
+
+
+@dataclass
+class InputEvent:
+    """A decoded press/release, motion or wheel event from an input report"""
+    timestamp: float
+    interface: int
+    source: str         # 'keyboard', 'consumer' or 'mouse'
+    action: str         # 'press', 'release', 'move' or 'wheel'
+    code: int = 0       # HID usage, consumer usage or mouse button bit
+    name: str = ''
+    dx: int = 0
+    dy: int = 0
+    wheel: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain dict for JSON output, without motion fields that don't apply"""
+        data = asdict(self)
+        if self.action != 'move':
+            del data['dx'], data['dy']
+        if self.action != 'wheel':
+            del data['wheel']
+        return data
+
+
+def _set_bits(bits: int) -> Iterable[int]:
+    """Yield the indices of the set bits of an int, lowest first"""
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+class ReportDecoder:
+    """
+    Turns raw input reports into press/release events
+
+    Each interface keeps the previous state of every report kind as a
+    bitset (keyboard usages, with modifiers at 0xE0-0xE7, and mouse
+    buttons) so presses and releases fall out of two integer operations per
+    report. Report kinds are recognised by shape:
+
+    - 8 bytes: boot keyboard report (modifiers, reserved, 6 keycodes)
+    - otherwise the first byte is a report ID, looked up in ``report_kinds``
+    """
+
+    # Report ID -> kind for composite interfaces
+    REPORT_KINDS = {1: 'keyboard', 2: 'mouse', 3: 'consumer'}
+
+    BOOT_REPORT_SIZE = 8
+
+    def __init__(self, report_kinds: Optional[Dict[int, str]] = None):
+        self.report_kinds = dict(self.REPORT_KINDS if report_kinds is None else report_kinds)
+        self._state: Dict[Tuple[int, str], int] = {}
+
+    def reset(self):
+        """Forget all previous state, e.g. after a keyboard was reconnected"""
+        self._state.clear()
+
+    def decode(self, report: InputReport) -> Optional[List[InputEvent]]:
+        """
+        Decode one report
+
+        Returns:
+            The events the report caused (empty if nothing changed), or None
+            if the report is not a recognised keyboard/consumer/mouse report
+        """
+        data = report.data
+        if len(data) == self.BOOT_REPORT_SIZE:
+            return self._keyboard(report, data)
+        if len(data) < 2:
+            return None
+
+        kind = self.report_kinds.get(data[0])
+        if kind == 'keyboard' and len(data) >= 9:
+            return self._keyboard(report, data[1:9])
+        if kind == 'consumer' and len(data) >= 3:
+            return self._consumer(report, data[1] | (data[2] << 8))
+        if kind == 'mouse' and len(data) >= 4:
+            return self._mouse(report, data[1:])
+        return None
+
+    def _diff(self, report: InputReport, source: str, bits: int,
+              names: Callable[[int], str]) -> List[InputEvent]:
+        key = (report.interface, source)
+        old = self._state.get(key, 0)
+        if bits == old:
+            return []
+        self._state[key] = bits
+
+        events = [InputEvent(report.timestamp, report.interface, source, 'release', code, names(code))
+                  for code in _set_bits(old & ~bits)]
+        events.extend(InputEvent(report.timestamp, report.interface, source, 'press', code, names(code))
+                      for code in _set_bits(bits & ~old))
+        return events
+
+    def _keyboard(self, report: InputReport, data: bytes) -> List[InputEvent]:
+        bits = data[0] << 0xE0
+        for code in data[2:8]:
+            # 0 = no key, 1-3 = rollover/error codes
+            if code > 3:
+                bits |= 1 << code
+        return self._diff(report, 'keyboard', bits, keycode_name)
+
+    def _consumer(self, report: InputReport, usage: int) -> List[InputEvent]:
+        # One usage at a time: a new usage releases the previous one
+        return self._diff(report, 'consumer', 1 << usage if usage else 0,
+                          media_keycode_name)
+
+    def _mouse(self, report: InputReport, data: bytes) -> List[InputEvent]:
+        events = self._diff(report, 'mouse', data[0] & 0x07,
+                            lambda bit: MOUSE_BUTTON_NAMES[1 << bit])
+        for event in events:
+            event.code = 1 << event.code
+
+        dx, dy = struct.unpack_from('<bb', data, 1)
+        if dx or dy:
+            events.append(InputEvent(report.timestamp, report.interface, 'mouse', 'move', dx=dx, dy=dy))
+        if len(data) > 3 and data[3]:
+            wheel = struct.unpack_from('<b', data, 3)[0]
+            events.append(InputEvent(report.timestamp, report.interface, 'mouse', 'wheel', wheel=wheel))
+        return events
+
+
+class HidMonitor:
+    """
+    Reads every keyboard interface on its own blocking reader thread
+
+    Reports from all interfaces are merged into one queue, timestamped as
+    soon as the read returns. Readers block inside hidapi rather than
+    polling, so an idle monitor uses next to no CPU and a report reaches
+    the consumer without waiting for other interfaces.
+    """
+
+    # Upper bound on how long stop() waits for a blocked reader
+    READ_TIMEOUT_MS = 200
+
+    def __init__(self, devices: Optional[List[dict]] = None,
+                 transport: Optional[Callable[[], Any]] = None):
+        import queue
+
+        self.devices = enumerate_devices() if devices is None else devices
+        self.transport = transport
+        self.interfaces: List[dict] = []
+        self.names: List[str] = []
+        self.queue: 'queue.Queue[Optional[InputReport]]' = queue.Queue()
+        self._stop = threading.Event()
+        self._handles = []
+        self._threads: List[threading.Thread] = []
+        self._live = 0
+        self._live_lock = threading.Lock()
+
+    def start(self) -> int:
+        """Open every readable interface and start its reader; returns the number opened"""
+        transport = self.transport or _hid().device
+        seen = set()
+        for dev_info in self.devices:
+            path = _path_str(dev_info)
+            if path in seen:
+                continue
+            seen.add(path)
+
+            try:
+                device = transport()
+                device.open_path(dev_info['path'])
+                device.set_nonblocking(False)
+            except Exception:
+                continue
+
+            index = len(self.interfaces)
+            iface = dev_info.get('interface_number', '?')
+            usage = dev_info.get('usage_page', 0)
+            self.interfaces.append(dev_info)
+            self.names.append(f"iface{iface}_0x{usage:04x}")
+            self._handles.append(device)
+
+        self._live = len(self._handles)
+        for index, device in enumerate(self._handles):
+            thread = threading.Thread(target=self._reader, args=(index, device),
+                                      name=f"turbokeys-monitor-{index}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+        return len(self._handles)
+
+    def _reader(self, index: int, device):
+        try:
+            while not self._stop.is_set():
+                data = device.read(64, timeout_ms=self.READ_TIMEOUT_MS)
+                if data:
+                    self.queue.put(InputReport(time.time(), index, bytes(data)))
+        except Exception:
+            # Interface went away (unplugged) - stop reading it
+            pass
+        finally:
+            with self._live_lock:
+                self._live -= 1
+                if self._live == 0:
+                    self.queue.put(None)
+
+    def reports(self, duration: Optional[float] = None) -> Iterable[InputReport]:
+        """
+        Yield reports as they arrive
+
+        Args:
+            duration: Stop after this many seconds (default: until stop() is
+                called or every interface has gone away)
+        """
+        import queue
+
+        deadline = None if duration is None else time.monotonic() + duration
+        while True:
+            # Wake up periodically so Ctrl+C is handled on every platform
+            wait = 0.5
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return
+
+            try:
+                report = self.queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+            if report is None:
+                return
+            yield report
+
+    def stop(self):
+        """Stop the readers and close every interface"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(self.READ_TIMEOUT_MS / 1000.0 + 1.0)
+
+        for device in self._handles:
+            try:
+                device.close()
+            except Exception:
+                pass
+        self._handles = []
+        self._threads = []
+
+    def __enter__(self) -> 'HidMonitor':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+# Capture files (.tkcap): a header, then fixed-size records that can be
+# memory-mapped and indexed directly. All values are little-endian.
+#
+#   header:  magic 'TKCAP\0', version u16, record size u16, data offset u32,
+#            start time f64, interface count u16
+#   names:   per interface, a u8 length and that many UTF-8 bytes
+#   padding: to data offset (a multiple of 16)
+#   record:  timestamp f64, interface u8, length u8, 6 pad, data 64 bytes
+CAPTURE_MAGIC = b'TKCAP\0'
+CAPTURE_VERSION = 1
+_CAPTURE_HEADER = struct.Struct('<6sHHIdH')
+_CAPTURE_RECORD = struct.Struct('<dBB6x64s')
+CAPTURE_RECORD_SIZE = _CAPTURE_RECORD.size
+
+
+class CaptureWriter:
+    """
+    Writes reports to a capture file through a large write buffer
+
+    Each report costs one struct pack and a buffered write, so capturing
+    adds almost nothing to the read loop.
+    """
+
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path: str, interfaces: Sequence[str], start_time: Optional[float] = None):
+        if len(interfaces) > 255:
+            raise ValueError("A capture can hold at most 255 interfaces")
+
+        names = b''.join(bytes([len(encoded)]) + encoded
+                         for encoded in (name.encode('utf-8')[:255] for name in interfaces))
+        data_offset = -(-(_CAPTURE_HEADER.size + len(names)) // 16) * 16
+
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'wb', buffering=self.BUFFER_SIZE)
+        self._file.write(_CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, CAPTURE_RECORD_SIZE,
+                                              data_offset, time.time() if start_time is None else start_time,
+                                              len(interfaces)))
+        self._file.write(names.ljust(data_offset - _CAPTURE_HEADER.size, b'\0'))
+
+    def write(self, report: InputReport):
+        """Append one report; data beyond 64 bytes is truncated"""
+        self.write_packet(report.timestamp, report.interface, report.data)
+
+    def write_packet(self, timestamp: float, interface: int, data: Sequence[int]):
+        """Append one record from its fields"""
+        data = bytes(data[:64])
+        self._file.write(_CAPTURE_RECORD.pack(timestamp, interface, len(data), data))
+        self.count += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self) -> 'CaptureWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class Capture:
+    """
+    A capture file opened read-only through mmap
+
+    Records are read lazily, so opening a multi-gigabyte capture is instant.
+    A record cut short by an interrupted capture is ignored.
+
+    Raises:
+        ValueError: If the file is not a capture file
+    """
+
+    def __init__(self, path: str):
+        import mmap
+
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(_CAPTURE_HEADER.size)
+            if len(header) < _CAPTURE_HEADER.size:
+                raise ValueError(f"{path} is not a capture file")
+            magic, version, record_size, data_offset, start_time, count = _CAPTURE_HEADER.unpack(header)
+            if magic != CAPTURE_MAGIC:
+                raise ValueError(f"{path} is not a capture file")
+            if version != CAPTURE_VERSION or record_size != CAPTURE_RECORD_SIZE:
+                raise ValueError(f"Unsupported capture version {version} in {path}")
+
+            self.start_time = start_time
+            self.data_offset = data_offset
+            self.interfaces: List[str] = []
+            for _ in range(count):
+                length = f.read(1)
+                name = f.read(length[0]) if length else b''
+                if not length or len(name) < length[0]:
+                    raise ValueError(f"{path} is not a capture file")
+                self.interfaces.append(name.decode('utf-8', 'replace'))
+
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.count = max(0, size - data_offset) // CAPTURE_RECORD_SIZE
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> InputReport:
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("capture record out of range")
+        timestamp, interface, length, data = _CAPTURE_RECORD.unpack_from(
+            self._map, self.data_offset + index * CAPTURE_RECORD_SIZE)
+        return InputReport(timestamp, interface, data[:length])
+
+    def __iter__(self) -> Iterable[InputReport]:
+        for index in range(self.count):
+            yield self[index]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self) -> 'Capture':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# Packet recordings are capture files with a single interface holding the
+# packets written to the keyboard, report ID included
+RECORD_INTERFACE = 0
+RECORD_INTERFACE_NAME = 'write'
+
+
+def packet_recorder(path: str) -> CaptureWriter:
+    """Open a capture file to record written packets to (MiniKeyboard recorder)"""
+    return CaptureWriter(path, [RECORD_INTERFACE_NAME])
+
+
+def replay_packets(keyboard: MiniKeyboard, capture: Capture, speed: float = 1.0) -> int:
+    """
+    Write a recorded packet stream to a connected keyboard
+
+    Packets go through the keyboard's normal write path (pacing and retries)
+    but skip profile compilation and the shadow record.
+
+    Args:
+        keyboard: Connected keyboard (or one using a SimulatedKeyboard transport)
+        capture: Recording made with packet_recorder()
+        speed: Timing relative to the recording: 1.0 is the original timing,
+            2.0 twice as fast, 0 as fast as the keyboard accepts
+
+    Returns:
+        Number of packets written; fewer than recorded if a write failed
+
+    Raises:
+        ValueError: If the capture is not a packet recording or speed is negative
+    """
+    if capture.interfaces != [RECORD_INTERFACE_NAME]:
+        raise ValueError(f"{capture.path} is a monitor capture, not a packet recording")
+    if speed < 0:
+        raise ValueError("Replay speed cannot be negative")
+
+    written = 0
+    first = None
+    start = time.perf_counter()
+    for record in capture:
+        if first is None:
+            first = record.timestamp
+        if speed:
+            delay = (record.timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if not keyboard._write_packet(record.data):
+            break
+        written += 1
+
+    return written
+
+
+def monitor_device(duration: int = 10, output: str = 'decoded', capture: Optional[str] = None):
+    """
+    Monitor HID traffic from the keyboard
+
+    Args:
+        duration: Seconds to monitor for
+        output: 'decoded' for readable press/release events, 'json' for one
+            JSON event per line, or 'raw' for the report bytes in hex
+        capture: Write reports to this capture file instead of printing them
+    """
+    monitor = HidMonitor()
+
+    if not monitor.devices:
+        print("No devices found")
+        return
+
+    # JSON lines go to stdout on their own so the output can be piped
+    log = sys.stderr if output == 'json' else sys.stdout
+
+    print(f"Monitoring keyboard for {duration} seconds. Press keys on the keyboard...", file=log)
+    print("(Watching all interfaces that can be read)\n", file=log)
+
+    # Open all readable interfaces
+    if not monitor.start():
+        print("Could not open any interfaces for reading", file=log)
+        return
+
+    for dev_info in monitor.interfaces:
+        print(f"  Opened interface {dev_info.get('interface_number', '?')} "
+              f"(usage 0x{dev_info.get('usage_page', 0):04x})", file=log)
+
+    print(f"\nListening... (press keys now)\n", file=log)
+
+    if capture:
+        _capture_reports(monitor, duration, capture)
+        return
+
+    if output == 'json':
+        import json
+
+    decoder = ReportDecoder()
+    start = time.time()
+    try:
+        for report in monitor.reports(duration):
+            name = monitor.names[report.interface]
+            events = None if output == 'raw' else decoder.decode(report)
+
+            if output == 'json':
+                if events is None:
+                    line = json.dumps({'timestamp': report.timestamp, 'interface': report.interface,
+                                       'source': 'raw', 'data': report.data.hex()})
+                else:
+                    line = '\n'.join(json.dumps(event.to_dict()) for event in events)
+                if line:
+                    print(line, flush=True)
+            elif events is None:
+                hex_str = ' '.join(f'{b:02x}' for b in report.data)
+                print(f"{report.timestamp - start:9.4f} [{name}] {hex_str}")
+            else:
+                for event in events:
+                    if event.action == 'move':
+                        desc = f"{event.dx:+d},{event.dy:+d}"
+                    elif event.action == 'wheel':
+                        desc = f"{event.wheel:+d}"
+                    else:
+                        desc = f"{event.name} (0x{event.code:02x})"
+                    print(f"{report.timestamp - start:9.4f} [{name}] {event.source:8s} "
+                          f"{event.action:7s} {desc}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
+
+    print("\nDone monitoring.", file=log)
+
+
+def _capture_reports(monitor: HidMonitor, duration: int, path: str):
+    """Write every report from a started monitor to a capture file"""
+    try:
+        writer = CaptureWriter(path, monitor.names)
+    except OSError as e:
+        monitor.stop()
+        print(f"Error: Cannot write capture: {e}")
+        return
+
+    try:
+        with writer:
+            for report in monitor.reports(duration):
+                writer.write(report)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
+
+    print(f"Captured {writer.count} report(s) to {path}")
+
+
+def print_profile(profile: Profile):
+    """Print the key mappings of a profile, grouped by layer"""
+    for mapping in sorted(profile.mappings, key=lambda m: (m.layer, m.physical_key)):
+        kind = mapping.key_type.name.lower()
+        print(f"  Layer {mapping.layer}, {physical_key_name(mapping.physical_key):12s} "
+              f"{kind:6s} {format_mapping(mapping)}")
+
+    if profile.led_mode is not None:
+        print(f"  LED mode: {profile.led_mode}")
+    print(f"{len(profile.mappings)} key mapping(s)")
+
+
+def apply_fleet(profile: Profile, incremental: bool = True, workers: int = 16):
+    """Apply a profile to every attached keyboard and report per-device results"""
+    fleet = Fleet(max_workers=workers, shadow=ShadowStore(), device_cache=DeviceInfoCache(),
+                  journal=ApplyJournal())
+    devices = fleet.discover()
+    if not devices:
+        print("No mini keyboard devices found")
+        return
+
+    print(f"Programming {len(devices)} keyboard(s)...")
+
+    def report(result: FleetResult):
+        if result.ok:
+            print(f"  OK    {result.device}: {result.written} key mapping(s) written "
+                  f"in {result.elapsed:.2f}s")
+        else:
+            print(f"  FAIL  {result.device}: {result.error}")
+
+    results = fleet.apply(profile, incremental=incremental, devices=devices, callback=report)
+    ok = sum(1 for r in results if r.ok)
+    print(f"{ok} of {len(results)} keyboard(s) programmed")
+
+
+def run_via_daemon(args, profile: Optional[Profile] = None):
+    """Send a set/led/apply command to turbokeysd"""
+    from turbokeysd import DaemonClient
+
+    with DaemonClient() as client:
+        try:
+            if args.command == 'set':
+                client.request('set', key=args.key, mapping=args.mapping, layer=args.layer)
+                print(f"Set {args.key} to '{args.mapping.lower()}' on layer {args.layer}")
+
+            elif args.command == 'led':
+                client.request('led', mode=args.mode)
+                print(f"Set LED mode to {args.mode}")
+
+            elif args.command == 'apply':
+                # The profile was loaded and validated here; send the parsed
+                # mappings field by field so nothing is re-read from names
+                state = profile_state(profile)
+                if args.all:
+                    devices = [entry['device'] for entry in client.request('list')['devices']]
+                else:
+                    devices = [None]
+                for device in devices:
+                    reply = client.request('apply', state=state, full=args.full, device=device)
+                    print(f"Applied {reply['written']} of {reply['total']} key mapping(s) "
+                          f"from {args.profile} to {reply['device']}")
+        except (ConnectionError, ValueError) as e:
+            print(f"Error: {e}")
+
+
+def replay_recording(path: str, speed: float = 1.0, simulate: bool = False):
+    """Replay a packet recording against the keyboard or the simulator"""
+    try:
+        capture = Capture(path)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not open recording '{path}': {e}")
+        return
+
+    with capture:
+        if not len(capture):
+            print(f"{path} holds no packets")
+            return
+
+        if simulate:
+            # Accept the report ID the recording was made with
+            sim = SimulatedKeyboard(report_ids=(capture[0].data[0],))
+            kb = MiniKeyboard(transport=sim.transport)
+            connected = kb.connect(sim.device_info)
+        else:
+            kb = MiniKeyboard(device_cache=DeviceInfoCache())
+            connected = kb.connect()
+        if not connected:
+            print("Error: Could not connect to keyboard")
+            return
+
+        device = kb.device_key
+        recorded_id = capture[0].data[0]
+        if recorded_id != kb.report_id:
+            print(f"Warning: recorded with report ID {recorded_id}, keyboard uses {kb.report_id}")
+
+        try:
+            start = time.perf_counter()
+            written = replay_packets(kb, capture, speed)
+            elapsed = time.perf_counter() - start
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        finally:
+            kb.disconnect()
+
+        if written and not simulate:
+            # The keyboard no longer matches the shadow record
+            ShadowStore().discard(device)
+
+        rate = f" ({written / elapsed:.0f} packets/s)" if elapsed > 0 else ""
+        print(f"Replayed {written} of {len(capture)} packet(s) in {elapsed:.3f}s{rate}")
+        if simulate:
+            print(f"Simulated keyboard: {sim.flash_count} flash commit(s)")
+
+
+def device_keys(dev_info: dict) -> List[str]:
+    """Names a keyboard can be assigned by: device_id(), and its USB port if that differs"""
+    keys = [device_id(dev_info)]
+    port = _port_path(dev_info)
+    if port != _path_str(dev_info) and f"port:{port}" not in keys:
+        keys.append(f"port:{port}")
+    return keys
+
+
+def watch_devices(assignments: Dict[str, Profile], default: Optional[Profile] = None,
+                  incremental: bool = True):
+    """
+    Apply each keyboard's assigned profile whenever it is plugged in
+
+    Args:
+        assignments: Profile per keyboard, keyed by 'serial:...', 'port:...'
+            or 'path:...'
+        default: Profile for keyboards without an assignment
+        incremental: Only write what differs from each keyboard's shadow record
+    """
+    fleet = Fleet(shadow=ShadowStore(), device_cache=DeviceInfoCache(), journal=ApplyJournal())
+
+    def added(dev_info: dict):
+        keys = device_keys(dev_info)
+        profile = next((assignments[key] for key in keys if key in assignments), default)
+        if profile is None:
+            print(f"Connected {keys[0]} (no profile assigned)")
+            return
+
+        result = fleet.apply_device(dev_info, profile, incremental)
+        if result.ok:
+            print(f"Connected {result.device}: {result.written} key mapping(s) written "
+                  f"in {result.elapsed:.2f}s")
+        else:
+            print(f"Connected {result.device}: FAILED, {result.error}")
+
+    def removed(dev_info: dict):
+        print(f"Disconnected {device_id(dev_info)}")
+
+    watcher = HotplugWatcher(added, removed)
+    print("Watching for keyboards (Ctrl+C to stop)...")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv: Optional[List[str]] = None):
+    """CLI interface"""
+    import argparse
+
+    if argv is None:
+        argv = sys.argv[1:]
 
     parser = argparse.ArgumentParser(
         description='Mini Keyboard Configurator - Configure cheap macro keyboards',
@@ -731,46 +3422,112 @@ Examples:
   %(prog)s set key1 ctrl+c               # Set key 1 to Ctrl+C
   %(prog)s set knob1_cw volup            # Set knob clockwise to volume up
   %(prog)s set key5 f5 --layer 2         # Set key 5 to F5 on layer 2
+  %(prog)s set key6 ctrl+c,ctrl+v        # Set key 6 to a copy-paste macro
+  %(prog)s set knob1_cw wheelup          # Set knob clockwise to scroll up
   %(prog)s led 1                         # Set LED mode 1
+  %(prog)s apply profile.toml            # Apply a whole profile (TOML/JSON/YAML)
+  %(prog)s apply --all profile.toml      # Apply it to every attached keyboard
+  %(prog)s monitor -t 600 -c soak.tkcap  # Capture reports to a binary file
+  %(prog)s analyze soak.tkcap            # Press counts, latencies, gaps (needs NumPy)
+  %(prog)s apply p.toml --record s.tkcap # Record the packets written to the keyboard
+  %(prog)s replay s.tkcap --speed 0      # Replay them as fast as the keyboard accepts
+  %(prog)s set key1 a --daemon           # Send through a running turbokeysd (fast)
+  %(prog)s watch --default profile.toml  # Apply a profile to every keyboard plugged in
 
 Physical keys: key1-key12, knob1_left/press/right (k1_left/k1_press/k1_right)
 Modifiers: ctrl, shift, alt, win
 Media keys: play, pause, next, prev, volup, voldown, mute
+Mouse: lclick, rclick, mclick, wheelup, wheeldown, wheel:<n>, move:<dx>:<dy>
+
+Debug commands (reverse engineering): debug, debug-init, debug-set
         """
     )
 
     subparsers = parser.add_subparsers(dest='command', help='Commands')
 
+    # Shared by the commands that write to the keyboard
+    record_parser = argparse.ArgumentParser(add_help=False)
+    record_parser.add_argument('--record', metavar='FILE',
+                               help='Record every packet written to the keyboard, for replay')
+    record_parser.add_argument('--daemon', '-d', action='store_true',
+                               help='Send the command to a running turbokeysd instead of opening the keyboard')
+
     # List command
     subparsers.add_parser('list', help='List connected devices')
 
-    # Debug command
-    subparsers.add_parser('debug', help='Debug: probe all interfaces')
-
     # Monitor command
     monitor_parser = subparsers.add_parser('monitor', help='Monitor HID traffic from keyboard')
     monitor_parser.add_argument('--time', '-t', type=int, default=10, help='Duration in seconds (default: 10)')
-
-    # Debug init command
-    subparsers.add_parser('debug-init', help='Debug: try init sequences for 0x8840')
-
-    # Debug set command
-    debug_set_parser = subparsers.add_parser('debug-set', help='Debug: try setting key1 to A on all interfaces')
-    debug_set_parser.add_argument('--key', '-k', type=int, default=1, help='Physical key number (default: 1)')
-    debug_set_parser.add_argument('--code', '-c', type=int, default=4, help='Keycode (default: 4 = A)')
+    monitor_output = monitor_parser.add_mutually_exclusive_group()
+    monitor_output.add_argument('--raw', action='store_const', dest='output', const='raw',
+                                help='Print raw report bytes instead of decoded events')
+    monitor_output.add_argument('--json', action='store_const', dest='output', const='json',
+                                help='Print one JSON event per line')
+    monitor_output.add_argument('--capture', '-c', metavar='FILE',
+                                help='Write reports to a binary capture file (.tkcap) instead of printing')
+
+    # Analyze command
+    analyze_parser = subparsers.add_parser('analyze', help='Analyze a capture file (needs NumPy)')
+    analyze_parser.add_argument('capture', help='Capture file written by monitor --capture')
+    analyze_parser.add_argument('--idle', type=float, default=0.25,
+                                help='Seconds without reports that end a burst (default: 0.25)')
+    analyze_parser.add_argument('--gap-factor', type=float, default=1.8,
+                                help='In-burst interval, as a multiple of the median, '
+                                     'that counts as a dropped-report gap (default: 1.8)')
 
     # Set command
-    set_parser = subparsers.add_parser('set', help='Set a key mapping')
+    set_parser = subparsers.add_parser('set', help='Set a key mapping', parents=[record_parser])
     set_parser.add_argument('key', help='Physical key (key1-key12, knob1_left, etc.)')
-    set_parser.add_argument('mapping', help='Key to map (a-z, f1-f12, ctrl+c, volup, etc.)')
+    set_parser.add_argument('mapping', help='Key to map (a-z, f1-f12, ctrl+c, volup, etc.), '
+                                            'or a macro like ctrl+c,ctrl+v')
     set_parser.add_argument('--layer', '-l', type=int, default=1,
                            help='Layer (1-3, default: 1)')
 
     # LED command
-    led_parser = subparsers.add_parser('led', help='Set LED mode')
+    led_parser = subparsers.add_parser('led', help='Set LED mode', parents=[record_parser])
     led_parser.add_argument('mode', type=int, help='LED mode (0=off, 1=on, 2=breathing)')
 
-    args = parser.parse_args()
+    # Apply command
+    apply_parser = subparsers.add_parser('apply', help='Apply a profile file (TOML, JSON or YAML)',
+                                         parents=[record_parser])
+    apply_parser.add_argument('profile', help='Profile file (.toml, .json, .yaml)')
+    apply_parser.add_argument('--dry-run', '-n', action='store_true',
+                              help='Validate and print the profile without connecting')
+    apply_parser.add_argument('--full', action='store_true',
+                              help='Write every key, even if the last applied state matches')
+    apply_parser.add_argument('--all', '-a', action='store_true',
+                              help='Program every attached keyboard in parallel')
+    apply_parser.add_argument('--workers', '-w', type=int, default=16,
+                              help='Keyboards programmed at once with --all (default: 16)')
+
+    # Watch command
+    watch_parser = subparsers.add_parser('watch', help='Apply profiles automatically when keyboards are plugged in')
+    watch_parser.add_argument('--assign', metavar='DEVICE=PROFILE', action='append', default=[],
+                              help='Profile for one keyboard, by serial:..., port:... or path:... '
+                                   '(see list); may be repeated')
+    watch_parser.add_argument('--default', metavar='PROFILE',
+                              help='Profile for keyboards without an assignment')
+    watch_parser.add_argument('--full', action='store_true',
+                              help='Write every key, even if the last applied state matches')
+
+    # Replay command
+    replay_parser = subparsers.add_parser('replay', help='Replay packets recorded with --record')
+    replay_parser.add_argument('recording', help='Recording file')
+    replay_speed = replay_parser.add_mutually_exclusive_group()
+    replay_speed.add_argument('--speed', '-s', type=float, default=1.0,
+                              help='Timing relative to the recording, 0 = as fast as possible (default: 1)')
+    replay_speed.add_argument('--max-speed', action='store_const', dest='speed', const=0.0,
+                              help='Same as --speed 0')
+    replay_parser.add_argument('--simulate', action='store_true',
+                               help='Replay against the simulated keyboard instead of a device')
+
+    # Debug commands are only declared (and their module loaded) when used
+    command = next((arg for arg in argv if not arg.startswith('-')), '')
+    if command.startswith('debug'):
+        import turbokeys_debug
+        turbokeys_debug.add_parsers(subparsers)
+
+    args = parser.parse_args(argv)
 
     if not args.command:
         parser.print_help()
@@ -780,24 +3537,87 @@ Media keys: play, pause, next, prev, volup, voldown, mute
         list_devices()
         return
 
-    if args.command == 'debug':
-        debug_interfaces()
+    if args.command == 'monitor':
+        monitor_device(args.time, args.output or 'decoded', args.capture)
+        return
+
+    if args.command == 'analyze':
+        import turbokeys_analyze
+        try:
+            stats = turbokeys_analyze.analyze_capture(args.capture, idle=args.idle,
+                                                      gap_factor=args.gap_factor)
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not analyze '{args.capture}': {e}")
+            return
+        turbokeys_analyze.print_analysis(stats)
         return
 
-    if args.command == 'monitor':
-        monitor_device(args.time)
+    if args.command.startswith('debug'):
+        import turbokeys_debug
+        turbokeys_debug.run(args)
         return
 
-    if args.command == 'debug-init':
-        debug_init_sequences()
+    if args.command == 'replay':
+        replay_recording(args.recording, args.speed, args.simulate)
         return
 
-    if args.command == 'debug-set':
-        debug_set_key(args.key, args.code)
+    if args.command == 'watch':
+        assignments = {}
+        try:
+            for assignment in args.assign:
+                device, sep, path = assignment.partition('=')
+                if not sep or not device or not path:
+                    raise ValueError(f"Invalid assignment '{assignment}', expected DEVICE=PROFILE")
+                assignments[device] = load_profile(path)
+            default = load_profile(args.default) if args.default else None
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return
+        if not assignments and default is None:
+            print("Error: Nothing to apply, give --assign and/or --default")
+            return
+        watch_devices(assignments, default, incremental=not args.full)
+        return
+
+    # Parse and validate input before touching the device
+    if args.command == 'led' and not 0 <= args.mode <= 255:
+        print(f"Error: Invalid LED mode {args.mode}. Must be 0-255")
+        return
+
+    if args.command == 'set':
+        try:
+            mapping = parse_mapping(args.key, args.mapping, args.layer)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+
+    if args.command == 'apply':
+        try:
+            profile = load_profile(args.profile)
+        except (OSError, ValueError) as e:
+            print(f"Error: Could not load profile '{args.profile}': {e}")
+            return
+
+        if args.dry_run:
+            print_profile(profile)
+            return
+
+        if args.all and not args.daemon:
+            if args.record:
+                print("Error: --record records a single keyboard and cannot be used with --all")
+                return
+            apply_fleet(profile, incremental=not args.full, workers=args.workers)
+            return
+
+    if args.daemon:
+        if args.record:
+            print("Error: --record cannot be used with --daemon")
+            return
+        run_via_daemon(args, profile if args.command == 'apply' else None)
         return
 
     # Commands that need device connection
-    kb = MiniKeyboard()
+    kb = MiniKeyboard(shadow=ShadowStore(), device_cache=DeviceInfoCache(), journal=ApplyJournal())
 
     if not kb.connect():
         print("Error: Could not connect to keyboard")
@@ -805,37 +3625,29 @@ Media keys: play, pause, next, prev, volup, voldown, mute
         print("On Linux, you may need to add a udev rule or run as root.")
         return
 
-    try:
-        if args.command == 'set':
-            # Parse physical key
-            key_name = args.key.lower()
-            if key_name not in PHYSICAL_KEYS:
-                print(f"Error: Unknown physical key '{args.key}'")
-                print(f"Valid keys: {', '.join(sorted(PHYSICAL_KEYS.keys()))}")
-                return
+    if kb.resumed:
+        kept, total = kb.resumed
+        print(f"Finished an interrupted write ({total - kept} of {total} packet(s) sent again)")
 
-            physical_key = PHYSICAL_KEYS[key_name]
-            mapping = args.mapping.lower()
+    if args.record:
+        try:
+            kb.recorder = packet_recorder(args.record)
+        except OSError as e:
+            kb.disconnect()
+            print(f"Error: Cannot write recording: {e}")
+            return
 
-            # Check if it's a media key
-            if mapping in MEDIA_KEYCODES:
-                media_code = MEDIA_KEYCODES[mapping]
-                if kb.set_media_key(physical_key, media_code, args.layer):
-                    print(f"Set {args.key} to media key '{mapping}' on layer {args.layer}")
+    try:
+        if args.command == 'set':
+            if kb.apply_profile([mapping]):
+                if mapping.key_type == KeyType.MEDIA:
+                    print(f"Set {args.key} to media key '{args.mapping.lower()}' on layer {args.layer}")
+                elif mapping.key_type == KeyType.MOUSE:
+                    print(f"Set {args.key} to mouse action '{args.mapping.lower()}' on layer {args.layer}")
                 else:
-                    print("Failed to set key mapping")
+                    print(f"Set {args.key} to '{args.mapping.lower()}' on layer {args.layer}")
             else:
-                # Parse as basic key combo
-                modifiers, keycode = parse_key_combo(mapping)
-                if keycode == 0:
-                    print(f"Error: Unknown key '{mapping}'")
-                    print(f"Valid keys: {', '.join(sorted(KEYCODES.keys()))}")
-                    return
-
-                if kb.set_basic_key(physical_key, keycode, modifiers, args.layer):
-                    print(f"Set {args.key} to '{mapping}' on layer {args.layer}")
-                else:
-                    print("Failed to set key mapping")
+                print("Failed to set key mapping")
 
         elif args.command == 'led':
             if kb.set_led_mode(args.mode):
@@ -843,8 +3655,33 @@ Media keys: play, pause, next, prev, volup, voldown, mute
             else:
                 print("Failed to set LED mode")
 
+        elif args.command == 'apply':
+            incremental = not args.full
+            pending = kb.pending_mappings(profile.mappings) if incremental else profile.mappings
+
+            if not pending:
+                print(f"All {len(profile.mappings)} key mapping(s) already applied, nothing to write")
+            elif kb.apply_profile(pending):
+                print(f"Applied {len(pending)} of {len(profile.mappings)} key mapping(s) from {args.profile}")
+            else:
+                print("Failed to apply profile")
+                return
+
+            if profile.led_mode is not None:
+                if incremental and kb.shadow.led_mode(kb.device_key) == profile.led_mode:
+                    print(f"LED mode {profile.led_mode} already applied")
+                elif kb.set_led_mode(profile.led_mode):
+                    print(f"Set LED mode to {profile.led_mode}")
+                else:
+                    print("Failed to set LED mode")
+
+    except ValueError as e:
+        print(f"Error: {e}")
     finally:
         kb.disconnect()
+        if kb.recorder is not None:
+            kb.recorder.close()
+            print(f"Recorded {kb.recorder.count} packet(s) to {args.record}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of monitor capture files (.tkcap)
+
+Captures are memory-mapped as a NumPy structured array and processed in
+fixed-size chunks, so memory use stays flat however large the capture is
+and every statistic is computed with array operations rather than a loop
+per report. Loaded by turbokeys only when the analyze command is run.
+
+Needs NumPy: pip install numpy
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from turbokeys import (Capture, CAPTURE_RECORD_SIZE, KEYCODE_NAMES, MOUSE_BUTTON_NAMES,
+                       ReportDecoder, media_keycode_name)
+
+
+# Inter-report interval histogram: log-spaced bins from 0.1 ms to 10 s
+HISTOGRAM_MIN = 1e-4
+HISTOGRAM_MAX = 10.0
+HISTOGRAM_BINS_PER_DECADE = 20
+
+# Records processed per chunk (80 bytes each, plus a 256-column key state
+# matrix for the keyboard reports in the chunk)
+CHUNK_RECORDS = 1 << 16
+
+
+@dataclass
+class RotationRate:
+    """Detents per second while a knob (or any repeating key) was being turned"""
+    bursts: int
+    median_per_s: float
+    peak_per_s: float
+
+
+@dataclass
+class CaptureStats:
+    """Statistics computed from a capture file"""
+    records: int
+    duration: float
+    interfaces: List[str]
+    key_presses: Dict[str, int] = field(default_factory=dict)
+    consumer_presses: Dict[str, int] = field(default_factory=dict)
+    mouse_presses: Dict[str, int] = field(default_factory=dict)
+    latency_edges: List[float] = field(default_factory=list)
+    latency_counts: List[int] = field(default_factory=list)
+    rotation: Dict[str, RotationRate] = field(default_factory=dict)
+    gaps: int = 0
+    largest_gaps: List[Tuple[float, int, float]] = field(default_factory=list)   # (timestamp, interface, seconds)
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError("Capture analysis needs NumPy: pip install numpy") from None
+    return numpy
+
+
+def capture_dtype():
+    """NumPy dtype of one capture record"""
+    np = _numpy()
+    dtype = np.dtype([('timestamp', '<f8'), ('interface', 'u1'), ('length', 'u1'),
+                      ('pad', 'V6'), ('data', 'u1', (64,))])
+    assert dtype.itemsize == CAPTURE_RECORD_SIZE
+    return dtype
+
+
+def load_records(path: str):
+    """
+    Memory-map the records of a capture file
+
+    Returns:
+        (capture, records): the opened Capture (for its header fields) and a
+        read-only structured array over the records
+
+    Raises:
+        ValueError: If the file is not a capture file or NumPy is missing
+    """
+    np = _numpy()
+    capture = Capture(path)
+    if not capture.count:
+        return capture, np.zeros(0, dtype=capture_dtype())
+    records = np.memmap(path, dtype=capture_dtype(), mode='r',
+                        offset=capture.data_offset, shape=(capture.count,))
+    return capture, records
+
+
+class _InterfaceState:
+    """Carries report state across chunk boundaries for one interface"""
+
+    def __init__(self, np, bins: int):
+        self.last_time: Optional[float] = None
+        self.keys = np.zeros(256, dtype=bool)
+        self.usage = 0
+        self.buttons = 0
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        self.largest: List[Tuple[float, float]] = []       # (seconds, timestamp), in-burst only
+
+
+class _Analyzer:
+    def __init__(self, np, interfaces: int, idle: float):
+        self.np = np
+        self.idle = idle
+        decades = np.log10(HISTOGRAM_MAX / HISTOGRAM_MIN)
+        self.edges = np.logspace(np.log10(HISTOGRAM_MIN), np.log10(HISTOGRAM_MAX),
+                                 int(round(decades * HISTOGRAM_BINS_PER_DECADE)) + 1)
+        self.state = [_InterfaceState(np, len(self.edges) - 1) for _ in range(interfaces)]
+        self.key_counts = np.zeros(256, dtype=np.int64)
+        self.consumer_counts: Dict[int, int] = {}
+        self.mouse_counts: Dict[str, int] = {}
+        # name -> list of press timestamp arrays, for rotation rates
+        self.press_times: Dict[str, list] = {}
+
+    def _presses(self, name: str, times):
+        if len(times):
+            self.press_times.setdefault(name, []).append(times)
+
+    def chunk(self, records):
+        np = self.np
+        iface_column = records['interface']
+        for iface in np.unique(iface_column):
+            rows = records[iface_column == iface]
+            if iface >= len(self.state):
+                self.state.extend(_InterfaceState(np, len(self.edges) - 1)
+                                  for _ in range(iface + 1 - len(self.state)))
+            state = self.state[iface]
+
+            times = rows['timestamp']
+            length = rows['length']
+            data = rows['data']
+
+            self._intervals(state, times)
+
+            boot = length == ReportDecoder.BOOT_REPORT_SIZE
+            report_id = data[:, 0]
+            keyboard = boot | ((length >= 9) & (report_id == 1))
+            consumer = ~boot & (length >= 3) & (report_id == 3)
+            mouse = ~boot & (length >= 4) & (report_id == 2)
+
+            if keyboard.any():
+                # Boot reports start at byte 0, report ID 1 reports at byte 1
+                reports = np.where(boot[keyboard, None], data[keyboard, 0:8], data[keyboard, 1:9])
+                self._keyboard(state, times[keyboard], reports)
+            if consumer.any():
+                self._consumer(state, times[consumer], data[consumer])
+            if mouse.any():
+                self._mouse(state, times[mouse], data[mouse], length[mouse])
+
+    def _intervals(self, state: _InterfaceState, times):
+        np = self.np
+        if state.last_time is not None:
+            deltas = np.diff(times, prepend=state.last_time)
+            ends = times
+        else:
+            deltas = np.diff(times)
+            ends = times[1:]
+        state.last_time = float(times[-1])
+        if not len(deltas):
+            return
+
+        counts, _ = np.histogram(np.clip(deltas, HISTOGRAM_MIN, HISTOGRAM_MAX), bins=self.edges)
+        state.histogram += counts
+
+        # Keep the ten longest in-burst intervals as dropped-report candidates
+        active = deltas < self.idle
+        if active.any():
+            candidates = deltas[active]
+            stamps = ends[active]
+            top = np.argsort(candidates)[-10:]
+            state.largest.extend(zip(candidates[top].tolist(), stamps[top].tolist()))
+            state.largest = sorted(state.largest, reverse=True)[:10]
+
+    def _keyboard(self, state: _InterfaceState, times, reports):
+        np = self.np
+        count = len(reports)
+
+        held = np.zeros((count, 256), dtype=bool)
+        held[np.arange(count)[:, None], reports[:, 2:8]] = True
+        held[:, :4] = False                               # no key / rollover codes
+        held[:, 0xE0:0xE8] = (reports[:, 0:1] >> np.arange(8, dtype=np.uint8)) & 1
+
+        previous = np.empty_like(held)
+        previous[0] = state.keys
+        previous[1:] = held[:-1]
+        state.keys = held[-1].copy()
+
+        pressed = held & ~previous
+        self.key_counts += pressed.sum(axis=0)
+
+        rows, codes = np.nonzero(pressed)
+        for code in np.unique(codes):
+            self._presses(KEYCODE_NAMES[code] or f"0x{code:02x}", times[rows[codes == code]])
+
+    def _consumer(self, state: _InterfaceState, times, data):
+        np = self.np
+        usage = data[:, 1].astype(np.uint16) | (data[:, 2].astype(np.uint16) << 8)
+        previous = np.concatenate(([state.usage], usage[:-1]))
+        state.usage = int(usage[-1])
+
+        pressed = (usage != 0) & (usage != previous)
+        codes, counts = np.unique(usage[pressed], return_counts=True)
+        for code, count in zip(codes.tolist(), counts.tolist()):
+            self.consumer_counts[code] = self.consumer_counts.get(code, 0) + count
+            self._presses(media_keycode_name(code), times[pressed & (usage == code)])
+
+    def _mouse(self, state: _InterfaceState, times, data, length):
+        np = self.np
+        buttons = data[:, 1] & 0x07
+        previous = np.concatenate(([state.buttons], buttons[:-1])).astype(np.uint8)
+        state.buttons = int(buttons[-1])
+
+        pressed = buttons & ~previous
+        for bit in (1, 2, 4):
+            hits = (pressed & bit) != 0
+            if hits.any():
+                name = MOUSE_BUTTON_NAMES[bit]
+                self.mouse_counts[name] = self.mouse_counts.get(name, 0) + int(hits.sum())
+                self._presses(name, times[hits])
+
+        wheel = np.where(length >= 5, data[:, 4].view(np.int8), 0)
+        for name, hits in (('wheelup', wheel > 0), ('wheeldown', wheel < 0)):
+            if hits.any():
+                self.mouse_counts[name] = self.mouse_counts.get(name, 0) + int(hits.sum())
+                self._presses(name, times[hits])
+
+    def rotation_rates(self, min_detents: int) -> Dict[str, RotationRate]:
+        """Split each name's presses into bursts separated by idle time"""
+        np = self.np
+        rates = {}
+        for name, chunks in self.press_times.items():
+            times = np.sort(np.concatenate(chunks))
+            starts = np.flatnonzero(np.diff(times, prepend=-np.inf) > self.idle)
+            ends = np.append(starts[1:], len(times)) - 1
+            detents = ends - starts + 1
+            spans = times[ends] - times[starts]
+
+            bursts = (detents >= min_detents) & (spans > 0)
+            if not bursts.any():
+                continue
+            per_s = (detents[bursts] - 1) / spans[bursts]
+            rates[name] = RotationRate(int(bursts.sum()), float(np.median(per_s)), float(per_s.max()))
+        return rates
+
+    def gaps(self, gap_factor: float) -> Tuple[int, List[Tuple[float, int, float]]]:
+        """
+        Count in-burst intervals longer than gap_factor x the interface's
+        median in-burst interval
+
+        The median and count come from the histogram, so both are accurate
+        to one bin width (about 12%).
+        """
+        np = self.np
+        total = 0
+        largest = []
+        idle_bin = np.searchsorted(self.edges, self.idle, side='right') - 1
+        for iface, state in enumerate(self.state):
+            active = state.histogram[:idle_bin]
+            if active.sum() == 0:
+                continue
+            median_bin = np.searchsorted(np.cumsum(active), active.sum() / 2.0)
+            median = np.sqrt(self.edges[median_bin] * self.edges[median_bin + 1])
+            threshold = median * gap_factor
+
+            first = np.searchsorted(self.edges, threshold)
+            total += int(active[first:].sum())
+            largest.extend((stamp, iface, seconds) for seconds, stamp in state.largest
+                           if seconds > threshold)
+
+        largest.sort(key=lambda gap: gap[2], reverse=True)
+        return total, largest[:10]
+
+
+def analyze_capture(path: str, idle: float = 0.25, gap_factor: float = 1.8,
+                    min_detents: int = 3) -> CaptureStats:
+    """
+    Analyze a capture file
+
+    Args:
+        path: Capture file written by monitor --capture
+        idle: An interval longer than this (seconds) ends a burst of activity
+        gap_factor: An in-burst interval this many times the interface's
+            median interval counts as a dropped-report gap
+        min_detents: Presses needed in a burst before it counts as rotation
+
+    Returns:
+        CaptureStats with press counts, an inter-report interval histogram,
+        rotation rates and dropped-report gaps
+
+    Raises:
+        ValueError: If the file is not a capture file or NumPy is missing
+    """
+    np = _numpy()
+    capture, records = load_records(path)
+    try:
+        analyzer = _Analyzer(np, len(capture.interfaces), idle)
+        for start in range(0, len(records), CHUNK_RECORDS):
+            # Copy the chunk out of the map so each column is read once
+            analyzer.chunk(np.array(records[start:start + CHUNK_RECORDS]))
+
+        stats = CaptureStats(records=len(records), duration=0.0, interfaces=list(capture.interfaces))
+        if len(records):
+            stats.duration = float(records['timestamp'][-1] - records['timestamp'][0])
+    finally:
+        del records
+        capture.close()
+
+    stats.key_presses = {KEYCODE_NAMES[code] or f"0x{code:02x}": int(analyzer.key_counts[code])
+                         for code in np.flatnonzero(analyzer.key_counts)}
+    stats.consumer_presses = {media_keycode_name(code): count
+                              for code, count in sorted(analyzer.consumer_counts.items())}
+    stats.mouse_presses = dict(analyzer.mouse_counts)
+
+    histogram = np.sum([state.histogram for state in analyzer.state], axis=0) \
+        if analyzer.state else np.zeros(len(analyzer.edges) - 1, dtype=np.int64)
+    stats.latency_edges = analyzer.edges.tolist()
+    stats.latency_counts = histogram.tolist()
+    stats.rotation = analyzer.rotation_rates(min_detents)
+    stats.gaps, stats.largest_gaps = analyzer.gaps(gap_factor)
+    return stats
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds < 1.0:
+        return f"{seconds * 1000:.3g} ms"
+    return f"{seconds:.3g} s"
+
+
+def print_analysis(stats: CaptureStats):
+    """Print capture statistics in readable form"""
+    print(f"{stats.records} report(s) over {_format_seconds(stats.duration)} "
+          f"from {len(stats.interfaces)} interface(s)")
+
+    for title, presses in (("Key presses", stats.key_presses),
+                           ("Media key presses", stats.consumer_presses),
+                           ("Mouse presses", stats.mouse_presses)):
+        if presses:
+            print(f"\n{title}:")
+            for name, count in sorted(presses.items(), key=lambda item: -item[1]):
+                print(f"  {name:12s} {count:10d}")
+
+    counts = stats.latency_counts
+    if any(counts):
+        print("\nInterval between reports (per interface):")
+        # Show 5 bins per decade, merged from the finer analysis bins
+        step = max(1, HISTOGRAM_BINS_PER_DECADE // 5)
+        peak = max(sum(counts[i:i + step]) for i in range(0, len(counts), step))
+        for i in range(0, len(counts), step):
+            count = sum(counts[i:i + step])
+            if not count:
+                continue
+            low, high = stats.latency_edges[i], stats.latency_edges[min(i + step, len(counts))]
+            bar = '#' * max(1, round(40 * count / peak))
+            print(f"  {_format_seconds(low):>9s} - {_format_seconds(high):<9s} {count:10d} {bar}")
+
+    if stats.rotation:
+        print("\nRotation / repeat rates (detents per second):")
+        for name, rate in sorted(stats.rotation.items()):
+            print(f"  {name:12s} {rate.bursts:6d} burst(s)  median {rate.median_per_s:7.1f}  "
+                  f"peak {rate.peak_per_s:7.1f}")
+
+    print(f"\nDropped-report gaps: {stats.gaps}")
+    for timestamp, iface, seconds in stats.largest_gaps:
+        name = stats.interfaces[iface] if iface < len(stats.interfaces) else f"interface {iface}"
+        print(f"  {_format_seconds(seconds):>9s} at {timestamp:.4f} [{name}]")
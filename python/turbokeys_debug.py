@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Debug tooling for reverse engineering keyboard variants
+
+Probes interfaces, initialization sequences and packet formats on attached
+keyboards. Loaded by turbokeys only when a debug command is run.
+"""
+
+import time
+
+from turbokeys import KeyType, _hid, enumerate_devices
+
+
+def add_parsers(subparsers):
+    """Register the debug subcommands on the turbokeys argument parser"""
+    # Debug command
+    subparsers.add_parser('debug', help='Debug: probe all interfaces')
+
+    # Debug init command
+    subparsers.add_parser('debug-init', help='Debug: try init sequences for 0x8840')
+
+    # Debug set command
+    debug_set_parser = subparsers.add_parser('debug-set', help='Debug: try setting key1 to A on all interfaces')
+    debug_set_parser.add_argument('--key', '-k', type=int, default=1, help='Physical key number (default: 1)')
+    debug_set_parser.add_argument('--code', '-c', type=int, default=4, help='Keycode (default: 4 = A)')
+
+
+def run(args):
+    """Run the debug subcommand selected on the command line"""
+    if args.command == 'debug':
+        debug_interfaces()
+    elif args.command == 'debug-init':
+        debug_init_sequences()
+    elif args.command == 'debug-set':
+        debug_set_key(args.key, args.code)
+
+
+def debug_interfaces():
+    """Debug: probe all interfaces and try different protocols"""
+    devices = enumerate_devices()
+
+    if not devices:
+        print("No devices found")
+        return
+
+    print(f"Found {len(devices)} interface(s). Testing each...\n")
+
+    for i, dev_info in enumerate(devices):
+        path = dev_info['path']
+        if isinstance(path, bytes):
+            path_str = path.decode('utf-8', errors='ignore')
+        else:
+            path_str = path
+
+        print(f"=== Interface {i} ===")
+        print(f"Path: {path_str}")
+        print(f"Interface number: {dev_info.get('interface_number', 'N/A')}")
+        print(f"Usage page: 0x{dev_info.get('usage_page', 0):04x}")
+        print(f"Usage: 0x{dev_info.get('usage', 0):04x}")
+
+        try:
+            device = _hid().device()
+            device.open_path(dev_info['path'])
+            device.set_nonblocking(True)
+            print("  Opened successfully")
+
+            # Try reading first to see if there's any data
+            print("  Attempting read...")
+            data = device.read(64, timeout_ms=500)
+            if data:
+                print(f"  Read data: {[hex(b) for b in data]}")
+            else:
+                print("  No data to read")
+
+            # Try different report IDs
+            for rid in [0, 2, 3]:
+                # Test write - just zeros
+                test_data = [rid] + [0] * 8
+                try:
+                    result = device.write(test_data)
+                    print(f"  Report ID {rid}: write OK ({result} bytes)")
+                except Exception as e:
+                    print(f"  Report ID {rid}: write FAIL - {e}")
+
+            # Try feature report
+            for rid in [0, 2, 3]:
+                try:
+                    feat = device.get_feature_report(rid, 9)
+                    if feat:
+                        print(f"  Feature report {rid}: {[hex(b) for b in feat]}")
+                except Exception as e:
+                    pass  # Feature reports often fail
+
+            device.close()
+        except Exception as e:
+            print(f"  Failed to open: {e}")
+
+        print()
+
+
+def debug_init_sequences():
+    """Try various initialization sequences that might unlock configuration"""
+    devices = [d for d in enumerate_devices() if d['product_id'] == 0x8840]
+    if not devices:
+        print("No 0x8840 device found")
+        return
+
+    # Find the vendor interface
+    dev_info = None
+    for d in devices:
+        if d.get('usage_page') == 0xff00:
+            dev_info = d
+            break
+
+    if not dev_info:
+        dev_info = devices[0]
+
+    print(f"Testing initialization sequences on 0x8840 device")
+    print(f"Interface: {dev_info.get('interface_number')}, Usage: 0x{dev_info.get('usage_page', 0):04x}\n")
+
+    device = _hid().device()
+    device.open_path(dev_info['path'])
+    device.set_nonblocking(True)
+
+    rid = 3
+    key = 1
+    keycode = 4  # 'A'
+    layer = 1
+    type_byte = (layer << 4) | KeyType.BASIC
+
+    # Common initialization sequences to try
+    init_sequences = [
+        ("Enter config mode 0xA0", [[rid, 0xA0, 0, 0, 0, 0, 0, 0, 0]]),
+        ("Enter config mode 0xA2", [[rid, 0xA2, 0, 0, 0, 0, 0, 0, 0]]),
+        ("Enter config mode 0xAA", [[rid, 0xAA, 0, 0, 0, 0, 0, 0, 0]]),
+        ("Read config 0xB0", [[rid, 0xB0, 0, 0, 0, 0, 0, 0, 0]]),
+        ("Init 0xFF", [[rid, 0xFF, 0, 0, 0, 0, 0, 0, 0]]),
+        ("Reset 0x00", [[rid, 0, 0, 0, 0, 0, 0, 0, 0]]),
+        ("Wake sequence", [
+            [rid, 0xA1, 1, 0, 0, 0, 0, 0, 0],  # Layer 1
+            [rid, 0xA0, 0, 0, 0, 0, 0, 0, 0],  # Config mode?
+        ]),
+        ("Double layer switch", [
+            [rid, 0xA1, 0, 0, 0, 0, 0, 0, 0],  # Layer 0
+            [rid, 0xA1, 1, 0, 0, 0, 0, 0, 0],  # Layer 1
+        ]),
+    ]
+
+    for name, init_pkts in init_sequences:
+        print(f"\n=== {name} ===")
+        try:
+            # Send init
+            for pkt in init_pkts:
+                result = device.write(pkt)
+                print(f"  Init: {[hex(b) for b in pkt[1:]]} -> {result}b")
+                time.sleep(0.05)
+
+            # Check for response
+            resp = device.read(64, timeout_ms=100)
+            if resp:
+                print(f"  Response: {[hex(b) for b in resp]}")
+
+            # Try setting key
+            config = [rid, key, type_byte, 1, 0, 0, keycode, 0, 0]
+            result = device.write(config)
+            print(f"  Config: {result}b")
+
+            # Flash
+            flash = [rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0]
+            result = device.write(flash)
+            print(f"  Flash: {result}b")
+
+            # Check response
+            resp = device.read(64, timeout_ms=100)
+            if resp:
+                print(f"  Response: {[hex(b) for b in resp]}")
+
+            time.sleep(0.3)
+        except Exception as e:
+            print(f"  Error: {e}")
+
+    # Try querying device info
+    print("\n=== Query device info ===")
+    query_cmds = [0x00, 0x01, 0x10, 0x20, 0x80, 0x90, 0xF0, 0xFF]
+    for cmd in query_cmds:
+        try:
+            device.write([rid, cmd, 0, 0, 0, 0, 0, 0, 0])
+            time.sleep(0.05)
+            resp = device.read(64, timeout_ms=100)
+            if resp:
+                print(f"  0x{cmd:02x}: {[hex(b) for b in resp]}")
+        except:
+            pass
+
+    device.close()
+    print("\nDone. Press key 1 to test if any sequence worked.")
+
+
+def debug_set_key(physical_key: int = 1, keycode: int = 4):
+    """Debug: try setting a key on all interfaces with various protocols"""
+    devices = enumerate_devices()
+
+    if not devices:
+        print("No devices found")
+        return
+
+    print(f"Attempting to set key {physical_key} to keycode {keycode} (A)")
+    print(f"Found {len(devices)} interface(s)\n")
+
+    # Only test interface 0 (vendor-specific) with various protocols
+    dev_info = devices[0]
+    print(f"Testing interface 0 (MI_00, usage=0x{dev_info.get('usage_page', 0):04x})")
+
+    try:
+        device = _hid().device()
+        device.open_path(dev_info['path'])
+        device.set_nonblocking(True)
+
+        rid = 3  # Only report ID that works
+        layer = 1
+        type_byte = (layer << 4) | KeyType.BASIC
+
+        # Protocol A: Try feature report instead of output report
+        print("\n=== Testing Feature Reports ===")
+        try:
+            feat_data = [rid, physical_key, type_byte, 1, 0, 0, keycode, 0, 0]
+            device.send_feature_report(feat_data)
+            print(f"  Feature report sent: {feat_data}")
+            device.send_feature_report([rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0])
+            print("  Flash feature sent")
+        except Exception as e:
+            print(f"  Feature report failed: {e}")
+
+        time.sleep(0.5)
+
+        # Protocol B: Different byte order - what if key number is byte 1 not byte 0?
+        print("\n=== Testing Alternate Byte Orders ===")
+        # Order 1: [cmd, key, type, ...]
+        packets = [
+            ("Cmd prefix", [rid, 0xA1, physical_key, type_byte, 1, 0, keycode, 0, 0]),
+            ("Key at byte 2", [rid, type_byte, physical_key, 1, 0, 0, keycode, 0, 0]),
+            ("Flat format", [rid, physical_key, keycode, 0, 0, 0, 0, 0, 0]),
+        ]
+        for name, pkt in packets:
+            try:
+                result = device.write(pkt)
+                print(f"  {name}: {pkt[1:]} -> {result} bytes")
+                device.write([rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0])
+            except Exception as e:
+                print(f"  {name} failed: {e}")
+            time.sleep(0.2)
+
+        # Protocol C: Larger packet sizes
+        print("\n=== Testing Larger Packets (64 bytes) ===")
+        big_packet = [rid] + [physical_key, type_byte, 1, 0, 0, keycode] + [0] * 57
+        try:
+            result = device.write(big_packet)
+            print(f"  64-byte packet: {result} bytes")
+            device.write([rid] + [0xAA, 0xAA] + [0] * 61)
+        except Exception as e:
+            print(f"  64-byte failed: {e}")
+
+        time.sleep(0.5)
+
+        # Protocol D: Try without report ID in data (raw write)
+        print("\n=== Testing Raw Writes ===")
+        raw_packets = [
+            [physical_key, type_byte, 1, 0, 0, keycode, 0, 0],
+            [0, physical_key, type_byte, 1, 0, 0, keycode, 0],
+        ]
+        for i, pkt in enumerate(raw_packets):
+            try:
+                result = device.write(pkt)
+                print(f"  Raw {i}: {pkt} -> {result} bytes")
+            except Exception as e:
+                print(f"  Raw {i} failed: {e}")
+
+        # Protocol E: Try reading response after write
+        print("\n=== Testing Write then Read ===")
+        device.write([rid, physical_key, type_byte, 1, 0, 0, keycode, 0, 0])
+        time.sleep(0.1)
+        response = device.read(64, timeout_ms=500)
+        if response:
+            print(f"  Response: {[hex(b) for b in response]}")
+        else:
+            print("  No response")
+
+        device.write([rid, 0xAA, 0xAA, 0, 0, 0, 0, 0, 0])
+        time.sleep(0.1)
+        response = device.read(64, timeout_ms=500)
+        if response:
+            print(f"  Flash response: {[hex(b) for b in response]}")
+        else:
+            print("  No flash response")
+
+        device.close()
+    except Exception as e:
+        print(f"Failed: {e}")
+
+    print("\n\nDone. Press key 1 to test.")
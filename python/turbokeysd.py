@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+turbokeysd - keeps keyboard connections open and takes commands over a socket
+
+Every turbokeys invocation normally enumerates, opens and probes the
+keyboard before it writes a handful of packets. The daemon does that once
+per keyboard and then serves set/apply/led/layer requests over a Unix
+domain socket, one JSON object per line:
+
+    -> {"command": "set", "key": "key1", "mapping": "ctrl+c"}
+    <- {"ok": true}
+
+    -> {"command": "led", "mode": 9}
+    <- {"ok": false, "error": "..."}
+
+apply takes "profile" in the profile file structure, or "state" as
+produced by profile_state(), which keeps every mapping field exactly.
+
+Requests may name a keyboard with "device" (an id from the list command);
+otherwise the first keyboard is used. Run it with:
+
+    python turbokeysd.py [--socket PATH]
+
+and send commands with turbokeys ... --daemon, or DaemonClient.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from turbokeys import (ApplyJournal, DeviceInfoCache, MiniKeyboard, Profile, ShadowStore, TransitionPlanner,
+                       _cache_dir, device_id, find_devices, parse_mapping, profile_from_dict,
+                       profile_from_state, profile_hash)
+
+
+def socket_path() -> str:
+    """Default daemon socket: $TURBOKEYS_SOCKET, else the runtime or cache directory"""
+    path = os.environ.get('TURBOKEYS_SOCKET')
+    if path:
+        return path
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'turbokeys.sock')
+    return os.path.join(_cache_dir(), 'turbokeysd.sock')
+
+
+class KeyboardDaemon:
+    """
+    Holds one open MiniKeyboard per attached keyboard and runs requests on them
+
+    Requests for the same keyboard are serialised with a per-keyboard lock;
+    different keyboards are served concurrently. A request that fails on a
+    stale connection (keyboard unplugged or reset) reconnects and is retried
+    once.
+
+    The daemon remembers the profile it last applied to each keyboard, so
+    switching between profiles uses a cached TransitionPlan. Up to
+    max_profiles recently applied profiles are kept for that.
+    """
+
+    def __init__(self, shadow: Optional[ShadowStore] = None,
+                 device_cache: Optional[DeviceInfoCache] = None,
+                 journal: Optional[ApplyJournal] = None, max_profiles: int = 64):
+        self.shadow = shadow
+        self.device_cache = device_cache
+        self.journal = journal
+        self.keyboards: Dict[str, MiniKeyboard] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.planner = TransitionPlanner()
+        self.max_profiles = max_profiles
+        self._profiles: 'OrderedDict[str, Profile]' = OrderedDict()     # profile_hash -> profile
+        self._applied: Dict[str, Profile] = {}      # device id -> profile last applied
+
+    def discover(self) -> List[str]:
+        """Connect to newly attached keyboards and forget removed ones; returns all device ids"""
+        attached = {device_id(dev_info): dev_info for dev_info in find_devices(refresh=True)}
+        with self._lock:
+            for key in [key for key in self.keyboards if key not in attached]:
+                # Leave a keyboard that is mid-request to fail and reconnect on its own
+                if self._locks[key].acquire(blocking=False):
+                    try:
+                        self.keyboards.pop(key).disconnect()
+                    except Exception:
+                        pass
+                    finally:
+                        self._locks[key].release()
+
+            for key, dev_info in attached.items():
+                if key in self.keyboards:
+                    continue
+                kb = MiniKeyboard(shadow=self.shadow, device_cache=self.device_cache,
+                                  journal=self.journal)
+                if kb.connect(dev_info):
+                    self.keyboards[key] = kb
+                    self._locks.setdefault(key, threading.Lock())
+            return list(self.keyboards)
+
+    def close(self):
+        with self._lock:
+            for kb in self.keyboards.values():
+                kb.disconnect()
+            self.keyboards.clear()
+
+    def _drop(self, key: str, kb: MiniKeyboard):
+        """Disconnect a failed keyboard once no request is using it"""
+        with self._locks[key]:
+            with self._lock:
+                # Another request may already have replaced it
+                if self.keyboards.get(key) is not kb:
+                    return
+                del self.keyboards[key]
+            try:
+                kb.disconnect()
+            except Exception:
+                pass
+
+    def _forget(self, kb: MiniKeyboard) -> bool:
+        """The keyboard is about to diverge from the profile last applied to it"""
+        self._applied.pop(kb.device_key, None)
+        return True
+
+    def _keyboard(self, device: Optional[str]) -> Tuple[str, MiniKeyboard]:
+        for attempt in range(2):
+            with self._lock:
+                if device is None and self.keyboards:
+                    key = next(iter(self.keyboards))
+                    return key, self.keyboards[key]
+                if device in self.keyboards:
+                    return device, self.keyboards[device]
+            if attempt == 0:
+                self.discover()
+        raise ValueError(f"Keyboard '{device}' not found" if device else "No keyboard found")
+
+    def _run(self, device: Optional[str], operation, error: str) -> Dict[str, Any]:
+        """
+        Run operation(kb) on a keyboard, reconnecting once if it fails
+
+        The operation returns False on failure, or True or a dict of extra
+        reply fields on success.
+        """
+        for attempt in range(2):
+            key, kb = self._keyboard(device)
+            with self._locks[key]:
+                result = operation(kb)
+            if result:
+                reply = dict(result) if isinstance(result, dict) else {}
+                reply.update(ok=True, device=key)
+                return reply
+            # The handle may be stale after a USB reset: reopen and retry
+            self._drop(key, kb)
+            device = key
+        raise ValueError(error)
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Run one request
+
+        Raises:
+            ValueError: If the request is invalid or the keyboard write failed
+        """
+        if not isinstance(request, dict):
+            raise ValueError("Request must be a JSON object")
+        command = request.get('command')
+        device = request.get('device')
+
+        if command == 'ping':
+            return {'ok': True}
+
+        if command == 'list':
+            devices = []
+            for key in self.discover():
+                kb = self.keyboards.get(key)
+                if kb is not None and kb.device_info:
+                    devices.append({'device': key, 'product_id': kb.device_info.get('product_id', 0),
+                                    'report_id': kb.report_id})
+            return {'ok': True, 'devices': devices}
+
+        if command == 'set':
+            mapping = parse_mapping(str(request.get('key', '')), str(request.get('mapping', '')),
+                                    int(request.get('layer', 1)))
+            return self._run(device, lambda kb: self._forget(kb) and kb.apply_profile([mapping]),
+                             "key write failed")
+
+        if command == 'led':
+            mode = int(request.get('mode', 0))
+            return self._run(device, lambda kb: self._forget(kb) and kb.set_led_mode(mode),
+                             "LED write failed")
+
+        if command == 'layer':
+            layer = int(request.get('layer', 1))
+            if not 1 <= layer <= 3:
+                raise ValueError(f"Invalid layer {layer}. Must be 1-3")
+            return self._run(device, lambda kb: kb._send_layer_switch(layer), "layer switch failed")
+
+        if command == 'apply':
+            if 'state' in request:
+                profile = profile_from_state(request['state'])
+            else:
+                profile = profile_from_dict(request.get('profile'))
+            incremental = not request.get('full', False)
+
+            # One object per distinct profile, so plan hashes are computed once
+            digest = profile_hash(profile)
+            with self._lock:
+                profile = self._profiles.setdefault(digest, profile)
+                self._profiles.move_to_end(digest)
+                while len(self._profiles) > self.max_profiles:
+                    self._profiles.popitem(last=False)
+
+            def apply(kb: MiniKeyboard):
+                current = self._applied.get(kb.device_key)
+                if incremental and current is not None:
+                    plan = self.planner.plan(current, profile)
+                    # With a shadow record, apply_transition writes exactly what it says differs
+                    written = len(kb.pending_mappings(profile.mappings) if kb.shadow else plan.mappings)
+                    if not kb.apply_transition(plan):
+                        return False
+                else:
+                    pending = kb.pending_mappings(profile.mappings) if incremental else profile.mappings
+                    if not kb.apply_profile(pending):
+                        return False
+                    if profile.led_mode is not None and not kb.set_led_mode(profile.led_mode, incremental):
+                        return False
+                    written = len(pending)
+                self._applied[kb.device_key] = profile
+                return {'written': written, 'total': len(profile.mappings)}
+
+            return self._run(device, apply, "profile write failed")
+
+        raise ValueError(f"Unknown command '{command}'")
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon: KeyboardDaemon = self.server.daemon
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = daemon.handle(json.loads(line))
+            except (ValueError, TypeError) as e:
+                reply = {'ok': False, 'error': str(e)}
+            except Exception as e:
+                reply = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def serve(path: Optional[str] = None, daemon: Optional[KeyboardDaemon] = None):
+    """
+    Serve requests until interrupted
+
+    Raises:
+        OSError: If the socket cannot be created or another daemon is running
+    """
+    if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+        raise OSError("turbokeysd needs Unix domain sockets, which this platform lacks")
+
+    path = path or socket_path()
+    if os.path.exists(path):
+        # Replace a socket left behind by a daemon that died, but not a live one
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise OSError(f"Another turbokeysd is already listening on {path}")
+        finally:
+            probe.close()
+
+    daemon = daemon or KeyboardDaemon(shadow=ShadowStore(), device_cache=DeviceInfoCache(),
+                                      journal=ApplyJournal())
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # The socket can reprogram keyboards, so only its owner may connect
+    old_umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, _RequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    server.daemon = daemon
+
+    try:
+        found = daemon.discover()
+        print(f"turbokeysd listening on {path} ({len(found)} keyboard(s) connected)")
+        server.serve_forever()
+    finally:
+        server.server_close()
+        daemon.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class DaemonClient:
+    """
+    Sends requests to a running turbokeysd
+
+    The connection is opened on the first request and reused, so a series
+    of requests costs one socket round trip each.
+
+    Example:
+        with DaemonClient() as client:
+            client.request('set', key='key1', mapping='ctrl+c')
+    """
+
+    def __init__(self, path: Optional[str] = None, timeout: float = 10.0):
+        self.path = path or socket_path()
+        self.timeout = timeout
+        self._socket: Optional[socket.socket] = None
+        self._file = None
+
+    def request(self, command: str, **params) -> Dict[str, Any]:
+        """
+        Send one request and return the daemon's reply
+
+        Raises:
+            ConnectionError: If the daemon is not running or hung up
+            ValueError: If the daemon rejected the request
+        """
+        if self._socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                sock.close()
+                raise ConnectionError(f"turbokeysd is not running ({self.path}): {e}") from None
+            self._socket = sock
+            self._file = sock.makefile('rb')
+
+        params['command'] = command
+        try:
+            self._socket.sendall(json.dumps(params).encode('utf-8') + b'\n')
+            line = self._file.readline()
+        except OSError as e:
+            self.close()
+            raise ConnectionError(f"Lost connection to turbokeysd: {e}") from None
+        if not line:
+            self.close()
+            raise ConnectionError("turbokeysd closed the connection")
+
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise ValueError(reply.get('error', 'request failed'))
+        return reply
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = None
+            self._file = None
+
+    def __enter__(self) -> 'DaemonClient':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Keep mini keyboards connected and serve commands '
+                                                 'over a Unix socket')
+    parser.add_argument('--socket', '-s', help=f'Socket path (default: {socket_path()})')
+    args = parser.parse_args(argv)
+
+    # Clean up the socket on a service manager's SIGTERM too
+    import signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Error: {e}")
+
+
+if __name__ == '__main__':
+    main()